@@ -1,6 +1,11 @@
+import codecs
 import os
 import platform
+import queue
+import struct
+import threading
 import time
+from array import array
 from dataclasses import dataclass, field
 from enum import Enum
 from typing import Optional
@@ -9,11 +14,17 @@ from serial.tools import list_ports
 
 import typer
 from rich.console import Console
+from rich.progress import BarColumn, DownloadColumn, Progress, TextColumn, TimeRemainingColumn, TransferSpeedColumn
 import sys
 
 import usb
 from usb.core import Device, Endpoint
 
+try:
+    import usb1
+except ImportError:  # libusb1 не обязателен (requirements-hotplug.txt) — без него устройства ищутся опросом
+    usb1 = None
+
 # import usb.core
 # import usb.backend.libusb1
 # backend = usb.backend.libusb1.get_backend(find_library=lambda x: "/usr/lib/usb")
@@ -21,6 +32,29 @@ from usb.core import Device, Endpoint
 if platform.system() == "Darwin" and "arm" in platform.platform():
     os.environ["DYLD_LIBRARY_PATH"] = "/opt/homebrew/lib"
 
+# Размер одного чтения: одна крупная передача забирает сразу много пакетов,
+# вместо вызова libusb на каждые 1024 байта
+DEFAULT_TRANSFER_SIZE = 64 * 1024
+# Сколько прочитанных передач может ждать вывода, и сколько выводится за раз
+DEFAULT_QUEUE_SIZE = 256
+WRITE_BATCH = 64
+DROP_REPORT_INTERVAL = 5.0
+# Кадр сообщения (--framed): [длина:u32 big-endian][данные]; кадр длиннее
+# MAX_FRAME_SIZE считается признаком рассинхронизации потока
+FRAME_HEADER = struct.Struct(">I")
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+# Таймаут одной передачи при потоковой записи, мс: телефон перестал читать
+WRITE_TIMEOUT = 5000
+# Android в режиме Accessory: VID Google и PID 0x2D00–0x2D05
+# (accessory, + adb, audio, audio + adb, accessory + audio, + adb)
+GOOGLE_VID = 0x18D1
+ACCESSORY_PIDS = range(0x2D00, 0x2D06)
+# Период опроса шины, если уведомлений hotplug нет (Windows, libusb1 не установлен)
+POLL_INTERVAL = 0.05
+# Сколько ждать устройство после переключения в Accessory Mode и после отключения, с
+ACCESSORY_TIMEOUT = 15.0
+RECONNECT_TIMEOUT = 5.0
+
 
 class AppMode(Enum):
     Write = "write"
@@ -28,10 +62,355 @@ class AppMode(Enum):
     # WriteArduino = 'write-arduino'
 
 
+class OverflowPolicy(Enum):
+    DropNew = "drop-new"
+    DropOld = "drop-old"
+    Block = "block"
+
+
+def is_accessory(dev) -> bool:
+    return dev.idVendor == GOOGLE_VID and dev.idProduct in ACCESSORY_PIDS
+
+
+class DeviceWatcher:
+    """Ожидание появления устройств на шине.
+
+    Если libusb поддерживает hotplug, поток слушает уведомления о
+    подключении и отключении и будит ждущих сразу; иначе шина
+    опрашивается каждые POLL_INTERVAL. Сами устройства в обоих случаях
+    ищет pyusb — уведомление только говорит, что пора посмотреть.
+    """
+
+    def __init__(self):
+        self.changed = threading.Condition()
+        self.generation = 0
+        self.context = None
+        self.handle = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    @property
+    def hotplug(self) -> bool:
+        return self.thread is not None
+
+    def start(self):
+        if usb1 is None or not usb1.hasCapability(usb1.CAP_HAS_HOTPLUG):
+            return
+        self.context = usb1.USBContext()
+        self.context.open()
+        self.handle = self.context.hotplugRegisterCallback(self._on_hotplug)
+        self.thread = threading.Thread(target=self._events, name="usb-hotplug", daemon=True)
+        self.thread.start()
+
+    def _on_hotplug(self, context, device, event):
+        with self.changed:
+            self.generation += 1
+            self.changed.notify_all()
+        return False  # не снимать callback
+
+    def _events(self):
+        while not self.stopped.is_set():
+            try:
+                self.context.handleEventsTimeout(tv=0.5)
+            except usb1.USBErrorInterrupted:
+                continue
+
+    def wait(self, match=None, timeout: float = 0) -> list:
+        """Устройства, подходящие под match (все, если None); ждёт до timeout секунд, пока их нет"""
+        deadline = time.monotonic() + timeout
+        # с hotplug опрос — только подстраховка на случай пропущенного события
+        interval = 0.5 if self.hotplug else POLL_INTERVAL
+        while True:
+            with self.changed:
+                seen = self.generation
+            found = list(usb.core.find(find_all=True, custom_match=match))
+            remaining = deadline - time.monotonic()
+            if found or remaining <= 0:
+                return found
+            with self.changed:
+                if self.generation == seen:
+                    self.changed.wait(min(remaining, interval))
+
+    def close(self):
+        if self.thread is None:
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.context.hotplugDeregisterCallback(self.handle)
+        self.context.close()
+        self.thread = None
+
+
+class TransferQueue:
+    """Ограниченная очередь передач от потока чтения USB к выводу.
+
+    Передачи идут в буферах из пула: прочитанный буфер целиком уходит в
+    очередь, после вывода возвращается в пул — байты не копируются.
+    Если вывод не успевает и очередь полна, политика решает, что
+    выбросить: новую передачу (drop-new), самую старую (drop-old) или
+    ничего (block) — тогда ждёт и чтение с устройства.
+    """
+
+    def __init__(self, size: int, policy: OverflowPolicy):
+        self.queue = queue.Queue(size)
+        self.free = queue.SimpleQueue()
+        self.policy = policy
+        self.closed = threading.Event()
+        self.dropped = 0
+        self.dropped_bytes = 0
+
+    def acquire(self, size: int) -> array:
+        """Свободный буфер из пула (новый, если пул пуст или размер чтения сменился)"""
+        try:
+            buf = self.free.get_nowait()
+        except queue.Empty:
+            return usb.util.create_buffer(size)
+        return buf if len(buf) == size else usb.util.create_buffer(size)
+
+    def release(self, buf: array):
+        self.free.put(buf)
+
+    def _drop(self, buf: array, n: int):
+        self.dropped += 1
+        self.dropped_bytes += n
+        self.release(buf)
+
+    def put(self, buf: array, n: int, stop: threading.Event):
+        """Ставит в очередь n байт из buf; буфер переходит очереди (или обратно в пул, если выброшен)"""
+        if self.policy == OverflowPolicy.Block:
+            while not stop.is_set():
+                try:
+                    self.queue.put((buf, n), timeout=0.5)
+                    return
+                except queue.Full:
+                    pass
+            self.release(buf)
+            return
+        try:
+            self.queue.put_nowait((buf, n))
+            return
+        except queue.Full:
+            pass
+        if self.policy == OverflowPolicy.DropNew:
+            self._drop(buf, n)
+            return
+        try:
+            self._drop(*self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        # кладёт только поток чтения, так что место уже есть
+        self.queue.put_nowait((buf, n))
+
+    def take(self, max_items: int, timeout: float) -> list:
+        """Пачка [(буфер, байт)]: первую передачу ждёт до timeout, остальные — сколько уже есть"""
+        try:
+            batch = [self.queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while len(batch) < max_items:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def close(self):
+        """Чтение закончено (вызывает поток чтения)"""
+        self.closed.set()
+
+    def finished(self) -> bool:
+        return self.closed.is_set() and self.queue.empty()
+
+
+def pack_frames(messages, transfer_size: int):
+    """Упаковывает сообщения в кадры и склеивает их в передачи до transfer_size байт.
+
+    Сообщение, которое само больше transfer_size, уходит отдельной передачей.
+    """
+    batch = bytearray()
+    for message in messages:
+        if len(message) > MAX_FRAME_SIZE:
+            raise ValueError(f"Сообщение длиннее {MAX_FRAME_SIZE} байт")
+        if batch and len(batch) + FRAME_HEADER.size + len(message) > transfer_size:
+            yield batch
+            batch = bytearray()
+        batch += FRAME_HEADER.pack(len(message))
+        batch += message
+    if batch:
+        yield batch
+
+
+class FrameDecoder:
+    """Пошаговая сборка кадров из передач любой нарезки.
+
+    Кадры, целиком лежащие в одной передаче, возвращаются срезами
+    memoryview этой передачи, без копирования (они действительны, пока
+    буфер передачи не вернулся в пул). Копируется только кадр,
+    разрезанный между передачами, — он дособирается в bytearray.
+    """
+
+    def __init__(self, max_size: int = MAX_FRAME_SIZE):
+        self.max_size = max_size
+        self.header = bytearray()  # начало заголовка из прошлой передачи
+        self.body = bytearray()  # начало кадра из прошлых передач
+        self.need = None  # длина собираемого кадра
+
+    def _length(self, length: int) -> int:
+        if length > self.max_size:
+            raise ValueError(f"Кадр длиной {length} байт: поток кадров рассинхронизирован")
+        return length
+
+    def feed(self, chunk) -> list:
+        """Данные очередной передачи -> список завершённых кадров"""
+        view = memoryview(chunk)
+        end = len(view)
+        pos = 0
+        frames = []
+        if self.header:
+            pos = min(FRAME_HEADER.size - len(self.header), end)
+            self.header += view[:pos]
+            if len(self.header) < FRAME_HEADER.size:
+                return frames
+            self.need = self._length(FRAME_HEADER.unpack(self.header)[0])
+            self.header.clear()
+        if self.need is not None:
+            take = min(self.need - len(self.body), end - pos)
+            self.body += view[pos:pos + take]
+            pos += take
+            if len(self.body) < self.need:
+                return frames
+            frames.append(self.body)
+            self.body = bytearray()
+            self.need = None
+        while end - pos >= FRAME_HEADER.size:
+            length = self._length(FRAME_HEADER.unpack_from(view, pos)[0])
+            start = pos + FRAME_HEADER.size
+            if end - start < length:
+                self.need = length
+                self.body += view[start:end]
+                return frames
+            frames.append(view[start:start + length])
+            pos = start + length
+        self.header += view[pos:end]
+        return frames
+
+
+class StdoutSink:
+    """Вывод в терминал текстом UTF-8, каждая передача — с новой строки (как раньше print).
+
+    Символ, разрезанный между передачами, декодер дособирает из начала
+    следующей; перевода строки внутри символа не будет.
+    """
+
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def write(self, chunks: list):
+        parts = []
+        for chunk in chunks:
+            parts.append(self.decoder.decode(chunk))
+            if not self.decoder.getstate()[0]:
+                parts.append("\n")
+        sys.stdout.write("".join(parts))
+        sys.stdout.flush()
+
+    def write_messages(self, messages: list):
+        """Сообщения (--framed): каждое целиком и с новой строки"""
+        sys.stdout.write("".join(str(m, "utf-8", "replace") + "\n" for m in messages))
+        sys.stdout.flush()
+
+    def close(self):
+        tail = self.decoder.decode(b"", final=True)
+        if tail:
+            sys.stdout.write(tail + "\n")
+            sys.stdout.flush()
+
+
+class FileSink:
+    """Сырые байты в файл (дописываются в конец)"""
+
+    def __init__(self, path: str):
+        self.file = open(path, "ab")
+
+    def write(self, chunks: list):
+        self.file.writelines(chunks)
+        self.file.flush()
+
+    def write_messages(self, messages: list):
+        """Сообщения пишутся снова кадрами — границы сохраняются для следующего читателя"""
+        self.write(framed(messages))
+
+    def close(self):
+        self.file.close()
+
+
+class PipeSink:
+    """Сырые байты в именованный канал (FIFO), который создаётся при необходимости.
+
+    Открытие ждёт читателя канала; если читатель ушёл, пачка
+    дописывается следующему. Пока читателя нет, очередь копится и
+    переполняется по своей политике — чтение с устройства не встаёт.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = None
+        if not os.path.exists(path):
+            os.mkfifo(path)
+
+    def write(self, chunks: list):
+        while True:
+            if self.file is None:
+                self.file = open(self.path, "wb")
+            try:
+                self.file.writelines(chunks)
+                self.file.flush()
+                return
+            except BrokenPipeError:
+                self.close()
+
+    def write_messages(self, messages: list):
+        self.write(framed(messages))
+
+    def close(self):
+        if self.file is not None:
+            try:
+                self.file.close()
+            except BrokenPipeError:
+                pass
+            self.file = None
+
+
+def framed(messages: list) -> list:
+    """[заголовок, сообщение, ...] для writelines — сообщения не копируются"""
+    parts = []
+    for message in messages:
+        parts.append(FRAME_HEADER.pack(len(message)))
+        parts.append(message)
+    return parts
+
+
+def make_sink(output: Optional[str], fifo: bool):
+    if output is None or output == "-":
+        return StdoutSink()
+    if fifo:
+        return PipeSink(output)
+    return FileSink(output)
+
+
 @dataclass
 class App:
     device: Optional[Device] = None
     console: Optional[Console] = field(default_factory=Console)
+    watcher: DeviceWatcher = field(default_factory=DeviceWatcher)
+    transfer_size: int = DEFAULT_TRANSFER_SIZE
+    # Сообщения кадрами с длиной (--framed) вместо «одна передача — одно сообщение»
+    framed: bool = False
+    # Endpoint'ы ищутся один раз, заново — только после переподключения
+    ep_in: Optional[Endpoint] = None
+    ep_out: Optional[Endpoint] = None
+    read_size: int = 0
+    write_size: int = 0
 
     def detect_xiaomi_device(self):
         """Определяет, является ли устройство Xiaomi"""
@@ -118,12 +497,10 @@ class App:
                 self.diagnose_usb_issues()
                 self.console.print("\n[bold blue]Продолжаем ожидание устройств...")
             
-            attempt = 0
             while not lst:
                 try:
-                    lst = list(usb.core.find(find_all=True))
-                    attempt += 1
-                    if attempt % 5 == 0:  # Каждые 5 секунд выводим подсказку
+                    lst = self.watcher.wait(timeout=5)
+                    if not lst:  # Каждые 5 секунд выводим подсказку
                         self.console.print(
                             "[dim]Все еще ждем... Убедитесь, что:\n"
                             "  - Устройство подключено через USB\n"
@@ -134,7 +511,7 @@ class App:
                     self.console.print(f"[bold red]Ошибка при поиске устройств: {e}")
                     if platform.system() == "Windows":
                         self.console.print("[bold yellow]На Windows могут потребоваться драйверы libusb!")
-                time.sleep(1)
+                    time.sleep(1)
 
         if len(lst) == 1:
             dev = lst[0]
@@ -272,8 +649,7 @@ class App:
                             "  3. Или отключить и снова подключить телефон"
                         )
                         # Пытаемся найти устройство в Accessory Mode
-                        time.sleep(1)
-                        devices = list(usb.core.find(find_all=True))
+                        devices = self.watcher.wait(is_accessory, timeout=1)
                         if devices:
                             self.device = devices[0]
                             self.console.print("[green]Используем существующее подключение")
@@ -295,25 +671,16 @@ class App:
         # На Android 15 может потребоваться больше времени
         self.console.print("\n[dim]Ожидание переподключения устройства...")
         self.console.print("[dim]На Android 15 это может занять больше времени...")
-        time.sleep(3)  # Увеличиваем время ожидания для Android 15
 
-        # Пытаемся найти устройство несколько раз
-        # На Android 15 может потребоваться больше попыток
+        # После переключения устройство появляется заново с VID/PID Accessory Mode;
+        # старое (ещё не отключившееся) устройство под фильтр не попадает
         dev = None
-        max_attempts = 15  # Увеличиваем количество попыток для Android 15
-        for attempt in range(max_attempts):
-            try:
-                # Ищем устройство по VID/PID или просто первое доступное
-                devices = list(usb.core.find(find_all=True))
-                if devices:
-                    # После переключения в Accessory Mode устройство может иметь другие параметры
-                    # Берем первое доступное устройство
-                    dev = devices[0]
-                    break
-                time.sleep(0.5)  # Ждем 0.5 секунды между попытками
-            except Exception as e:
-                self.console.print(f"[dim]Попытка {attempt + 1}/{max_attempts}...")
-                time.sleep(0.5)
+        try:
+            devices = self.watcher.wait(is_accessory, timeout=ACCESSORY_TIMEOUT)
+            if devices:
+                dev = devices[0]
+        except usb.core.USBError as e:
+            self.console.print(f"[dim]Ошибка при поиске устройства: {e}")
         
         if not dev:
             # Проверяем, является ли устройство Xiaomi для специальных инструкций
@@ -364,29 +731,53 @@ class App:
         self.console.print("[green]Устройство найдено после переключения в Accessory Mode")
         return
 
-    def accept_data(self):
-        self.console.print("[bold blue]Accepting data...")
-        
+    def resolve_endpoints(self):
+        """Находит IN/OUT endpoint'ы текущего устройства и размеры передач"""
+        cfg = self.device.get_active_configuration()
+        intf = cfg[(0, 0)]
+
+        def find(direction):
+            ep = usb.util.find_descriptor(
+                intf,
+                custom_match=lambda e: usb.util.endpoint_direction(e.bEndpointAddress) == direction,
+            )
+            if ep is None:
+                raise ValueError("Endpoint not found, is the device in accessory mode?")
+            return ep
+
+        ep_in = find(usb.util.ENDPOINT_IN)
+        ep_out = find(usb.util.ENDPOINT_OUT)
+
+        # Размер чтения кратен размеру пакета, иначе последний пакет
+        # передачи может не влезть в буфер (overflow)
+        packet = ep_in.wMaxPacketSize
+        self.read_size = max(packet, self.transfer_size // packet * packet)
+        packet = ep_out.wMaxPacketSize
+        self.write_size = max(packet, self.transfer_size // packet * packet)
+        self.ep_in, self.ep_out = ep_in, ep_out
+
+    def forget_endpoints(self):
+        """Сбрасывает endpoint'ы (устройство сменилось) — найдутся заново при следующем обращении"""
+        self.ep_in = self.ep_out = None
+
+    def read_loop(self, transfers: TransferQueue, stop: threading.Event):
+        """Поток чтения: передачи с устройства в transfers, пока не выставлен stop"""
         consecutive_errors = 0
         max_consecutive_errors = 5
-        
-        while True:
+        buf = None
+
+        while not stop.is_set():
             try:
-                # Получаем конфигурацию и интерфейс каждый раз (на случай переподключения)
-                cfg = self.device.get_active_configuration()
-                if_num = cfg[(0, 0)].bInterfaceNumber
-                intf = usb.util.find_descriptor(cfg, bInterfaceNumber=if_num)
-
-                ep_in: Endpoint = usb.util.find_descriptor(
-                    intf,
-                    custom_match=lambda e: usb.util.endpoint_direction(e.bEndpointAddress)
-                    == usb.util.ENDPOINT_IN,
-                )
-                
-                # Используем таймаут вместо 0, чтобы не блокировать навсегда
-                data = ep_in.read(size_or_buffer=1024, timeout=1000)  # 1 секунда таймаут
-                if data:
-                    print(bytes(data).decode())
+                if self.ep_in is None:
+                    self.resolve_endpoints()
+                if buf is None:
+                    buf = transfers.acquire(self.read_size)
+
+                # Таймаут вместо 0, чтобы не блокировать навсегда и вовремя заметить stop
+                n = self.ep_in.read(buf, timeout=1000)  # 1 секунда таймаут
+                if n:
+                    transfers.put(buf, n, stop)
+                    buf = None
                     consecutive_errors = 0  # Сброс счетчика ошибок при успешном чтении
                     
             except usb.core.USBError as e:
@@ -401,11 +792,12 @@ class App:
                     self.console.print(f"[bold red]Устройство отключено (ошибка {error_code})")
                     self.console.print("[yellow]Попытка переподключения...")
                     
-                    # Пытаемся найти устройство снова
-                    time.sleep(1)
-                    devices = list(usb.core.find(find_all=True))
+                    # Ждём, пока устройство снова появится в Accessory Mode
+                    devices = self.watcher.wait(is_accessory, timeout=RECONNECT_TIMEOUT)
                     if devices:
                         self.device = devices[0]
+                        self.forget_endpoints()
+                        buf = None
                         self.console.print("[green]Устройство переподключено")
                         consecutive_errors = 0
                         continue
@@ -421,13 +813,6 @@ class App:
                         self.console.print(f"[bold red]Слишком много ошибок подряд. Остановка.")
                         break
                         
-            except KeyboardInterrupt:
-                self.console.print("\n[bold yellow]Прерывание пользователем...")
-                try:
-                    self.device.detach_kernel_driver(0)
-                except:
-                    pass
-                break
             except Exception as e:
                 consecutive_errors += 1
                 self.console.print(f"[bold red]Неожиданная ошибка: {e}")
@@ -435,35 +820,157 @@ class App:
                     break
                 time.sleep(1)
 
+        transfers.close()
+
+    def accept_data(self, sink, queue_size: int = DEFAULT_QUEUE_SIZE, overflow: OverflowPolicy = OverflowPolicy.DropOld):
+        """Читает устройство в отдельном потоке, а здесь пачками пишет прочитанное в sink.
+
+        Медленный вывод (терминал, канал без читателя) больше не тормозит
+        чтение с USB: между ними очередь на queue_size передач.
+        """
+        self.console.print("[bold blue]Accepting data...")
+        decoder = None
+        if self.framed:
+            decoder = FrameDecoder()
+            if overflow != OverflowPolicy.Block:
+                # выброшенная передача порвала бы поток кадров
+                self.console.print("[yellow]В режиме кадров передачи не выбрасываются: политика block")
+                overflow = OverflowPolicy.Block
+        transfers = TransferQueue(queue_size, overflow)
+        stop = threading.Event()
+        reader = threading.Thread(target=self.read_loop, args=(transfers, stop), name="usb-reader", daemon=True)
+        reader.start()
+        reported, reported_at = 0, 0.0
+        try:
+            while not transfers.finished():
+                batch = transfers.take(WRITE_BATCH, timeout=0.2)
+                if not batch:
+                    continue
+                chunks = [memoryview(buf)[:n] for buf, n in batch]
+                if decoder is None:
+                    sink.write(chunks)
+                else:
+                    messages = []
+                    for chunk in chunks:
+                        messages.extend(decoder.feed(chunk))
+                    if messages:
+                        sink.write_messages(messages)
+                for buf, _ in batch:
+                    transfers.release(buf)
+                # о потерях — не чаще раза в DROP_REPORT_INTERVAL секунд
+                if transfers.dropped != reported and time.monotonic() - reported_at >= DROP_REPORT_INTERVAL:
+                    reported, reported_at = transfers.dropped, time.monotonic()
+                    self.report_drops(transfers)
+        except ValueError as e:
+            self.console.print(f"[bold red]{e}. Остановка.")
+        except KeyboardInterrupt:
+            self.console.print("\n[bold yellow]Прерывание пользователем...")
+            try:
+                self.device.detach_kernel_driver(0)
+            except:
+                pass
+        finally:
+            stop.set()
+            reader.join()
+            sink.close()
+            if transfers.dropped:
+                self.report_drops(transfers)
+
+    def report_drops(self, transfers: TransferQueue):
+        self.console.print(
+            f"[yellow]Вывод не успевает: выброшено передач {transfers.dropped} "
+            f"({transfers.dropped_bytes} байт), политика {transfers.policy.value}"
+        )
+
+    def send_transfer(self, transfer):
+        """Одна передача; ровно на целое число пакетов — закрывается пакетом нулевой длины"""
+        self.ep_out.write(transfer)
+        if transfer and len(transfer) % self.ep_out.wMaxPacketSize == 0:
+            self.ep_out.write(b"")
+
+    def send_messages(self, messages):
+        """Отправляет сообщения (bytes); с --framed — кадрами, много сообщений в одной передаче"""
+        if not self.framed:
+            for message in messages:
+                self.send_transfer(message)
+            return
+        for transfer in pack_frames(messages, self.transfer_size):
+            self.send_transfer(transfer)
+
+    def stream_transfers(self, source):
+        """Передачи из source: куски по write_size байт (кратно размеру пакета) в одном буфере"""
+        if self.framed:
+            # каждая строка — сообщение; кадры склеиваются в передачи
+            yield from pack_frames((line.rstrip(b"\r\n") for line in source), self.write_size)
+            return
+        buf = usb.util.create_buffer(self.write_size)
+        while True:
+            n = source.readinto(buf)
+            if not n:
+                return
+            yield buf if n == len(buf) else buf[:n]
+
+    def write_stream(self, source):
+        """Потоковая запись бинарного файла source: передачи идут подряд, без подтверждений"""
+        if self.ep_out is None:
+            self.resolve_endpoints()
+        try:
+            total = os.fstat(source.fileno()).st_size or None  # у канала размера нет
+        except (OSError, ValueError):
+            total = None
+
+        sent = last = 0
+        started = time.monotonic()
+        with Progress(
+            TextColumn("[bold blue]Writing"),
+            BarColumn(),
+            DownloadColumn(),
+            TransferSpeedColumn(),
+            TimeRemainingColumn(),
+            console=self.console,
+        ) as progress:
+            task = progress.add_task("write", total=total)
+            try:
+                for transfer in self.stream_transfers(source):
+                    self.ep_out.write(transfer, timeout=WRITE_TIMEOUT)
+                    last = len(transfer)
+                    sent += last
+                    progress.update(task, advance=last)
+                # Передача ровно на целое число пакетов для читателя не закончена —
+                # закрываем её пакетом нулевой длины
+                if last and last % self.ep_out.wMaxPacketSize == 0:
+                    self.ep_out.write(b"", timeout=WRITE_TIMEOUT)
+            except usb.core.USBError as e:
+                self.console.print(f"[bold red]Ошибка при отправке: {e}")
+            except KeyboardInterrupt:
+                self.console.print("\n[bold yellow]Прерывание пользователем...")
+
+        elapsed = max(time.monotonic() - started, 1e-9)
+        self.console.print(
+            f"[green]Отправлено {sent} байт за {elapsed:.1f} с ({sent / elapsed / 1e6:.2f} МБ/с)"
+        )
+
     def write(self):
         while True:
             try:
-                # Получаем конфигурацию и интерфейс каждый раз (на случай переподключения)
-                cfg = self.device.get_active_configuration()
-                if_num = cfg[(0, 0)].bInterfaceNumber
-                intf = usb.util.find_descriptor(cfg, bInterfaceNumber=if_num)
-
-                ep_out: Endpoint = usb.util.find_descriptor(
-                    intf,
-                    custom_match=lambda e: usb.util.endpoint_direction(e.bEndpointAddress)
-                    == usb.util.ENDPOINT_OUT,
-                )
-                
+                if self.ep_out is None:
+                    self.resolve_endpoints()
+
                 message = self.console.input("[bold blue]Write: ")
                 if not message:
                     continue
                     
-                ep_out.write(message.encode() if isinstance(message, str) else message)
+                self.send_messages([message.encode() if isinstance(message, str) else message])
                 self.console.print("[green]Сообщение отправлено")
                 
             except usb.core.USBError as e:
                 error_code = e.errno if hasattr(e, 'errno') else None
                 if error_code == 19:  # No such device
                     self.console.print("[bold red]Устройство отключено. Попытка переподключения...")
-                    time.sleep(1)
-                    devices = list(usb.core.find(find_all=True))
+                    devices = self.watcher.wait(is_accessory, timeout=RECONNECT_TIMEOUT)
                     if devices:
                         self.device = devices[0]
+                        self.forget_endpoints()
                         self.console.print("[green]Устройство переподключено")
                         continue
                     else:
@@ -497,8 +1004,22 @@ class App:
                     ser.write(user_input.encode())
 
 
-def main(mode: AppMode = AppMode.Read.value):
-    app = App()
+def main(
+    mode: AppMode = AppMode.Read.value,
+    transfer_size: int = DEFAULT_TRANSFER_SIZE,
+    framed: bool = typer.Option(False, help="Сообщения кадрами [длина:u32 BE][данные]"),
+    input_path: Optional[str] = typer.Option(
+        None, "--input", help="write: отправить файл целиком ('-' — stdin), без построчного ввода"
+    ),
+    output: Optional[str] = typer.Option(None, help="Файл для принятых данных (по умолчанию — терминал)"),
+    fifo: bool = typer.Option(False, help="Создать output как именованный канал (FIFO)"),
+    queue_size: int = DEFAULT_QUEUE_SIZE,
+    overflow: OverflowPolicy = OverflowPolicy.DropOld.value,
+):
+    app = App(transfer_size=transfer_size, framed=framed)
+    if fifo and not hasattr(os, "mkfifo"):
+        app.console.print("[bold red]Именованные каналы на этой системе не поддерживаются")
+        sys.exit(1)
     
     # Проверка прав администратора на Windows
     if platform.system() == "Windows":
@@ -513,16 +1034,30 @@ def main(mode: AppMode = AppMode.Read.value):
         except:
             pass
     
-    # if mode == AppMode.WriteArduino:
-    #     app.write_arduino()
-    # else:
-    app.select_device()
-    app.prepare_device()
-
-    if mode == AppMode.Write:
-        app.write()
+    app.watcher.start()
+    if app.watcher.hotplug:
+        app.console.print("[dim]Подключение устройств отслеживается через hotplug")
     else:
-        app.accept_data()
+        app.console.print("[dim]Hotplug недоступен, устройства ищутся опросом шины")
+
+    try:
+        # if mode == AppMode.WriteArduino:
+        #     app.write_arduino()
+        # else:
+        app.select_device()
+        app.prepare_device()
+
+        if mode == AppMode.Write and input_path == "-":
+            app.write_stream(sys.stdin.buffer)
+        elif mode == AppMode.Write and input_path:
+            with open(input_path, "rb") as source:
+                app.write_stream(source)
+        elif mode == AppMode.Write:
+            app.write()
+        else:
+            app.accept_data(make_sink(output, fifo), queue_size, OverflowPolicy(overflow))
+    finally:
+        app.watcher.close()
 
 
 if __name__ == "__main__":
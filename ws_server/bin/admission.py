@@ -0,0 +1,110 @@
+"""Допуск нагрузки для server.py и server2.py.
+
+    MAX_CONNECTIONS   соединений на воркер; сверх лимита рукопожатие
+                      получает HTTP 503, а соединение, успевшее
+                      открыться, закрывается с кодом 1013 (try again later)
+    RATE_LIMIT        сообщений в секунду на соединение (token bucket),
+    RATE_BURST        из них подряд без пауз — не больше RATE_BURST
+    max_inflight      единиц работы, обрабатываемых воркером одновременно;
+                      единицу выбирает сервер (server.py — сообщение,
+                      server2.py — символ или байт сообщения)
+
+0 отключает лимит. Сообщение сверх лимита не разбирается и не ставится
+в очередь: в ответ сразу идёт ошибка ERR_RATE_LIMITED или ERR_OVERLOADED
+(в JSON — с полем retry_after, секунды), и соединение остаётся открытым.
+"""
+import os
+import time
+from http import HTTPStatus
+
+import binproto
+import metrics
+
+MAX_CONNECTIONS = int(os.environ.get("MAX_CONNECTIONS", "10000"))
+RATE_LIMIT = float(os.environ.get("RATE_LIMIT", "0"))
+RATE_BURST = float(os.environ.get("RATE_BURST", "0")) or max(RATE_LIMIT, 1.0)
+# Подсказка клиенту при перегрузке воркера
+OVERLOADED_RETRY_AFTER = 0.1
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def take(self, cost=1):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+    def retry_after(self, cost=1):
+        """Через сколько секунд накопится cost токенов"""
+        return max(0.0, (cost - self.tokens) / self.rate)
+
+
+class Admission:
+    def __init__(self, max_inflight=0, max_connections=MAX_CONNECTIONS, rate=RATE_LIMIT, burst=RATE_BURST):
+        self.max_inflight = max_inflight
+        self.max_connections = max_connections
+        self.rate = rate
+        self.burst = burst
+        self.connections = 0
+        self.inflight = 0
+
+    def full(self):
+        return bool(self.max_connections) and self.connections >= self.max_connections
+
+    def process_request(self, connection, request):
+        """Хук process_request для websockets.serve: отказ ещё до рукопожатия"""
+        if self.full():
+            metrics.inc("rejected_total", "connections")
+            return connection.respond(HTTPStatus.SERVICE_UNAVAILABLE, "Too many connections, retry later\n")
+        return None
+
+    def connect(self):
+        """Учитывает соединение; False — лимит исчерпан (рукопожатия шли одновременно)"""
+        if self.full():
+            metrics.inc("rejected_total", "connections")
+            return False
+        self.connections += 1
+        return True
+
+    def disconnect(self):
+        self.connections -= 1
+
+    def bucket(self):
+        """Token bucket нового соединения (None без RATE_LIMIT)"""
+        return TokenBucket(self.rate, self.burst) if self.rate else None
+
+    def admit(self, bucket, cost=1):
+        """Ошибка-ответ, если сообщение не принято, иначе None (cost единиц работы заняты до release)"""
+        if bucket is not None and not bucket.take():
+            metrics.inc("rejected_total", "rate")
+            return {
+                "type": "error",
+                "code": binproto.ERR_RATE_LIMITED,
+                "message": "Rate limit exceeded, retry later",
+                "retry_after": round(bucket.retry_after(), 3),
+            }
+        # одно сообщение крупнее лимита пропускаем, если воркер свободен
+        if self.max_inflight and self.inflight and self.inflight + cost > self.max_inflight:
+            metrics.inc("rejected_total", "inflight")
+            return {
+                "type": "error",
+                "code": binproto.ERR_OVERLOADED,
+                "message": "Server is busy, retry later",
+                "retry_after": OVERLOADED_RETRY_AFTER,
+            }
+        self.inflight += cost
+        return None
+
+    def release(self, cost=1):
+        self.inflight -= cost
@@ -0,0 +1,322 @@
+"""Нагрузочный тест WebSocket-серверов.
+
+Сам поднимает нужный сервер (server.py или server2.py) с заданным числом
+воркеров (WORKERS) во временной папке и гоняет по нему сценарий из
+нескольких процессов-клиентов, чтобы генератор нагрузки сам не упирался
+в одно ядро. Считает пропускную способность, задержки p50/p99/p999 и
+пиковый RSS сервера (Linux), результаты можно сохранить в JSON и
+сравнить с прошлым прогоном.
+
+Сценарии:
+    calculate  поток calculate-запросов
+    set_ab     пачки set_ab по --burst сообщений без ожидания ответа
+    text       анализ текста размером --text-size байт; каждый запрос начинается
+               своим словом, чтобы мерить анализ, а не кэш результатов
+               (--same-text — один и тот же текст, т.е. попадания в кэш)
+    restore    шторм переподключений: connect + restore + close
+
+    python bench.py calculate set_ab --workers 1 2 4 --clients 2000 --duration 10 --out run.json
+    python bench.py calculate --compare run.json
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from array import array
+from urllib.parse import urlsplit
+
+import websockets
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+CALC_URL = "ws://127.0.0.1:8080"
+TEXT_URL = "ws://127.0.0.1:8765"
+
+
+async def calculate_client(url, opts, deadline, stats, n):
+    async with websockets.connect(f"{url}/?session=bench-{os.getpid()}-{n}") as ws:
+        await ws.recv()  # начальное состояние
+        msg = json.dumps({"type": "calculate", "a": 3, "b": 4, "operation": "*"})
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            await ws.send(msg)
+            await ws.recv()
+            stats.append(time.perf_counter() - started)
+
+
+async def set_ab_client(url, opts, deadline, stats, n):
+    # у каждого клиента своя сессия, чтобы не получать чужие рассылки
+    async with websockets.connect(f"{url}/?session=bench-{os.getpid()}-{n}") as ws:
+        await ws.recv()
+        while time.monotonic() < deadline:
+            sent = []
+            for i in range(opts.burst):
+                sent.append(time.perf_counter())
+                await ws.send(json.dumps({"type": "set_ab", "a": i, "b": n}))
+            for started in sent:
+                await ws.recv()
+                stats.append(time.perf_counter() - started)
+
+
+def make_text(size):
+    words = ["мама", "мыла", "раму", "hello", "world", "a", "synchronization", "тест"]
+    rnd = random.Random(size)
+    parts, total = [], 0
+    while total < size:
+        word = rnd.choice(words)
+        parts.append(word)
+        total += len(word.encode("utf-8")) + 1
+    return " ".join(parts)
+
+
+async def text_client(url, opts, deadline, stats, n):
+    async with websockets.connect(url, max_size=None) as ws:
+        msg = json.dumps({"text": opts.text}, ensure_ascii=False)
+        # JSON один раз, а уникальное первое слово дописывается в начало строки
+        head, tail = msg[:len('{"text": "')], msg[len('{"text": "'):]
+        i = 0
+        while time.monotonic() < deadline:
+            if not opts.same_text:
+                i += 1
+                msg = f"{head}bench{os.getpid()}x{n}x{i} {tail}"
+            started = time.perf_counter()
+            await ws.send(msg)
+            await ws.recv()
+            stats.append(time.perf_counter() - started)
+
+
+async def restore_client(url, opts, deadline, stats, n):
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        async with websockets.connect(url, max_size=None) as ws:
+            await ws.send('{"type": "restore"}')
+            await ws.recv()
+        stats.append(time.perf_counter() - started)
+
+
+# сценарий -> (скрипт сервера, адрес, клиент)
+SCENARIOS = {
+    "calculate": ("server.py", CALC_URL, calculate_client),
+    "set_ab": ("server.py", CALC_URL, set_ab_client),
+    "text": ("server2.py", TEXT_URL, text_client),
+    "restore": ("server2.py", TEXT_URL, restore_client),
+}
+
+
+async def run_clients(scenario, opts, clients):
+    _, url, client = SCENARIOS[scenario]
+    stats = array("d")
+    errors = 0
+    deadline = time.monotonic() + opts.duration
+
+    async def guarded(n):
+        nonlocal errors
+        # растягиваем подключение, чтобы не упереться в backlog сервера
+        await asyncio.sleep(random.random() * opts.ramp)
+        try:
+            await client(url, opts, deadline, stats, n)
+        except (OSError, websockets.WebSocketException, asyncio.TimeoutError):
+            errors += 1
+
+    await asyncio.gather(*(guarded(n) for n in range(clients)))
+    return stats.tobytes(), errors
+
+
+def client_process(args):
+    scenario, opts, clients = args
+    raise_nofile()
+    return asyncio.run(run_clients(scenario, opts, clients))
+
+
+def raise_nofile():
+    """Тысячи соединений не влезают в стандартный лимит 1024 дескриптора"""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def port_in_use(url):
+    """Порт сервера уже кто-то слушает — тогда мерили бы не тот сервер"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        if os.name == "posix":
+            # не спотыкаемся о TIME_WAIT от прошлого прогона; слушающий сокет всё равно мешает
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind(("0.0.0.0", urlsplit(url).port))
+        except OSError:
+            return True
+    return False
+
+
+async def wait_port(url, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            async with websockets.connect(url, max_size=None):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+def process_tree(pid):
+    """pid сервера и его воркеров (по /proc, только Linux)"""
+    pids = [pid]
+    try:
+        for entry in os.listdir("/proc"):
+            if entry.isdigit():
+                try:
+                    with open(f"/proc/{entry}/stat") as f:
+                        ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+                except (OSError, IndexError, ValueError):
+                    continue
+                if ppid == pid:
+                    pids.append(int(entry))
+    except OSError:
+        pass
+    return pids
+
+
+def peak_rss_mb(pid):
+    """Сумма пиковых RSS (VmHWM) процесса и его воркеров; None — если /proc недоступен"""
+    total = 0
+    for p in process_tree(pid):
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        total += int(line.split()[1])
+        except OSError:
+            continue
+    return round(total / 1024, 1) if total else None
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def bench(scenario, workers, opts):
+    script, url, _ = SCENARIOS[scenario]
+    if port_in_use(url):
+        raise RuntimeError(f"port {urlsplit(url).port} is already in use; stop the running server first")
+    env = dict(os.environ, WORKERS=str(workers), LOG_LEVEL="WARNING")
+    with tempfile.TemporaryDirectory(prefix="ws-bench-") as workdir:
+        server = subprocess.Popen(
+            [sys.executable, os.path.join(HERE, script)],
+            cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            asyncio.run(wait_port(url))
+            per_proc = [opts.clients // opts.procs + (i < opts.clients % opts.procs) for i in range(opts.procs)]
+            started = time.monotonic()
+            with multiprocessing.Pool(opts.procs) as pool:
+                parts = pool.map(client_process, [(scenario, opts, n) for n in per_proc if n])
+            elapsed = time.monotonic() - started
+            rss = peak_rss_mb(server.pid)
+            if server.poll() is not None:
+                raise RuntimeError(f"{script} exited with code {server.returncode} during the run")
+        finally:
+            server.terminate()
+            server.wait()
+
+    latencies = array("d")
+    errors = 0
+    for raw, errs in parts:
+        latencies.frombytes(raw)
+        errors += errs
+    latencies = sorted(latencies)
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 3)
+
+    return {
+        "scenario": scenario,
+        "workers": workers,
+        "clients": opts.clients,
+        "duration": round(elapsed, 3),
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": round(len(latencies) / opts.duration, 1),
+        "p50_ms": ms(percentile(latencies, 0.5)),
+        "p99_ms": ms(percentile(latencies, 0.99)),
+        "p999_ms": ms(percentile(latencies, 0.999)),
+        "peak_rss_mb": rss,
+    }
+
+
+def print_result(r, base=None):
+    line = (
+        f"{r['scenario']:<10} workers={r['workers']:<3} {r['throughput']:10.0f} req/s  "
+        f"p50={r['p50_ms']}ms p99={r['p99_ms']}ms p999={r['p999_ms']}ms  "
+        f"rss={r['peak_rss_mb']}MB errors={r['errors']}"
+    )
+    if base:
+        dt = (r["throughput"] / base["throughput"] - 1) * 100 if base["throughput"] else 0.0
+        line += f"  [throughput {dt:+.1f}% vs {base['throughput']:.0f}"
+        if base.get("p99_ms") and r["p99_ms"]:
+            line += f", p99 {(r['p99_ms'] / base['p99_ms'] - 1) * 100:+.1f}%"
+        line += "]"
+    print(line, flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("scenarios", nargs="*", default=["calculate"], help=", ".join(SCENARIOS))
+    parser.add_argument("--workers", type=int, nargs="+", default=[1])
+    parser.add_argument("--clients", type=int, default=64)
+    parser.add_argument("--procs", type=int, default=os.cpu_count() or 1, help="процессов-клиентов")
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--ramp", type=float, default=1.0, help="секунд на подключение всех клиентов")
+    parser.add_argument("--burst", type=int, default=20, help="set_ab: сообщений в пачке")
+    parser.add_argument("--text-size", type=int, default=64 * 1024, help="text: размер текста, байт")
+    parser.add_argument("--same-text", action="store_true", help="text: не менять текст между запросами (кэш)")
+    parser.add_argument("--out", help="сохранить результаты в JSON")
+    parser.add_argument("--compare", help="сравнить с результатами прошлого прогона (JSON)")
+    opts = parser.parse_args()
+    unknown = [s for s in opts.scenarios if s not in SCENARIOS]
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(unknown)}")
+    opts.text = make_text(opts.text_size)
+    raise_nofile()
+
+    baseline = {}
+    if opts.compare:
+        with open(opts.compare, encoding="utf-8") as f:
+            for r in json.load(f)["results"]:
+                baseline[(r["scenario"], r["workers"])] = r
+
+    results = []
+    for scenario in opts.scenarios:
+        for workers in opts.workers:
+            r = bench(scenario, workers, opts)
+            results.append(r)
+            print_result(r, baseline.get((scenario, workers)))
+
+    if opts.out:
+        meta = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": {k: v for k, v in vars(opts).items() if k != "text"},
+        }
+        with open(opts.out, "w", encoding="utf-8") as f:
+            json.dump({"meta": meta, "results": results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
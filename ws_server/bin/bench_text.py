@@ -0,0 +1,60 @@
+"""Микробенчмарк анализа текста: прежний analyze_text против textstats.
+
+    python bench_text.py --words 500000 --docs 1000
+"""
+import argparse
+import random
+import re
+import timeit
+
+import textstats
+
+
+def legacy_analyze(text):
+    """Прежняя реализация: re.split + список слов + словарь в цикле"""
+    tokens = [t for t in re.split(r"\s+", text.strip()) if t]
+    length_hist = {}
+    for t in tokens:
+        l = len(t)
+        length_hist[l] = length_hist.get(l, 0) + 1
+    return len(tokens), length_hist
+
+
+def make_text(words, rnd):
+    vocab = ["мама", "мыла", "раму", "hello", "world", "a", "synchronization", "тест", "x1", "—"]
+    return " ".join(rnd.choice(vocab) for _ in range(words))
+
+
+def run(label, fn, baseline=None, repeat=5):
+    best = min(timeit.repeat(fn, number=1, repeat=repeat))
+    line = f"{label:<34} {best * 1000:9.2f} ms"
+    if baseline:
+        line += f"  x{baseline / best:.1f}"
+    print(line)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--words", type=int, default=500_000, help="слов в большом документе")
+    parser.add_argument("--docs", type=int, default=1000, help="документов в батче")
+    parser.add_argument("--doc-words", type=int, default=200, help="слов в документе батча")
+    opts = parser.parse_args()
+
+    rnd = random.Random(0)
+    text = make_text(opts.words, rnd)
+    docs = [make_text(opts.doc_words, rnd) for _ in range(opts.docs)]
+    assert legacy_analyze(text) == textstats.analyze(text)[:2]
+
+    print(f"один документ, {opts.words} слов (numpy: {'да' if textstats.np is not None else 'нет'})")
+    base = run("legacy analyze_text", lambda: legacy_analyze(text))
+    run("textstats.analyze", lambda: textstats.analyze(text), base)
+    run("textstats.analyze(keep_tokens)", lambda: textstats.analyze(text, keep_tokens=True), base)
+
+    print(f"батч: {opts.docs} документов по {opts.doc_words} слов")
+    base = run("legacy, по одному", lambda: [legacy_analyze(d) for d in docs])
+    run("textstats.analyze_batch", lambda: textstats.analyze_batch(docs), base)
+
+
+if __name__ == "__main__":
+    main()
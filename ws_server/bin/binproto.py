@@ -0,0 +1,238 @@
+"""Компактный бинарный протокол для server.py и server2.py.
+
+Включается, если клиент при подключении запросил подпротокол SUBPROTOCOL
+(заголовок Sec-WebSocket-Protocol). Остальные клиенты работают по JSON.
+
+Каждый кадр — бинарное сообщение WebSocket: 1 байт типа, дальше поля
+little-endian. Ответы повторяют JSON-ответы сервера, но вместо текстов
+ошибок передают числовые коды ERR_*.
+
+Запросы:
+    SET_AB            a:f64 b:f64
+    GET_STATE         —
+    CALCULATE         op:char a:f64 b:f64
+    CALCULATE_BATCH   n:u32 ops:char[n] a:f64[n] b:f64[n]
+    TEXT              текст в UTF-8 до конца кадра
+    RESTORE           —
+    TEXT_BEGIN        —
+    TEXT_CHUNK        кусок текста в UTF-8 до конца кадра (может резать символ)
+    TEXT_END          —
+    ANALYZE_BATCH     n:u32 (len:u32 text:UTF-8[len])[n]
+    DOC_OPEN          начальный текст в UTF-8 до конца кадра
+    DOC_EDIT          offset:u32 delete:u32 insert:UTF-8 до конца кадра
+    DOC_CLOSE         —
+Ответы:
+    STATE             a:f64 b:f64
+    CALC_RESULT       result:f64
+    CALC_ERROR        code:u16
+    CALC_BATCH        n:u32 results:f64[n] (NaN — ошибка) m:u32 (index:u32 code:u16)[m]
+    RESULT            word_count:u32 updated_at:f64 k:u16 (length:u32 count:u32)[k]
+    RESTORE           как RESULT + len:u32 original:UTF-8[len]
+    PARTIAL           как RESULT (updated_at = NaN)
+    BATCH_RESULT      n:u32 (word_count:u32 k:u16 (length:u32 count:u32)[k])[n]
+    DOC_STATE         version:u32 word_count:u32 k:u16 (length:u32 count:u32)[k]
+    JSON              JSON-ответ в UTF-8 до конца кадра (редкие ответы сложной
+                      структуры: history, stats; такие запросы клиент шлёт
+                      обычным текстовым JSON-кадром)
+    ERROR             code:u16
+"""
+import json
+import math
+import struct
+import sys
+from array import array
+from datetime import datetime
+
+SUBPROTOCOL = "mobiledev.bin.v1"
+
+# Коды ошибок (в JSON-ответах дублируются полем "code")
+ERR_UNKNOWN_TYPE = 1
+ERR_BAD_REQUEST = 2
+ERR_DIV_ZERO = 3
+ERR_UNKNOWN_OP = 4
+ERR_EXPRESSION = 5
+ERR_OVERLOADED = 6
+ERR_RATE_LIMITED = 7
+ERR_OVERFLOW = 8
+
+REQ_SET_AB = 0x01
+REQ_GET_STATE = 0x02
+REQ_CALCULATE = 0x03
+REQ_CALCULATE_BATCH = 0x04
+REQ_TEXT = 0x10
+REQ_RESTORE = 0x11
+REQ_TEXT_BEGIN = 0x12
+REQ_TEXT_CHUNK = 0x13
+REQ_TEXT_END = 0x14
+REQ_ANALYZE_BATCH = 0x15
+REQ_DOC_OPEN = 0x16
+REQ_DOC_EDIT = 0x17
+REQ_DOC_CLOSE = 0x18
+
+RESP_STATE = 0x81
+RESP_CALC_RESULT = 0x82
+RESP_CALC_ERROR = 0x83
+RESP_CALC_BATCH = 0x84
+RESP_RESULT = 0x90
+RESP_RESTORE = 0x91
+RESP_PARTIAL = 0x92
+RESP_BATCH_RESULT = 0x93
+RESP_DOC_STATE = 0x94
+RESP_JSON = 0xFE
+RESP_ERROR = 0xFF
+
+_AB = struct.Struct("<dd")
+_CALC = struct.Struct("<cdd")
+_U32 = struct.Struct("<I")
+_TYPE_F64 = struct.Struct("<Bd")
+_TYPE_DD = struct.Struct("<Bdd")
+_TYPE_CODE = struct.Struct("<BH")
+_BATCH_ERR = struct.Struct("<IH")
+_HIST_HEAD = struct.Struct("<BIdH")
+_HIST_ITEM = struct.Struct("<II")
+_DOC_HEAD = struct.Struct("<IH")
+_F64 = struct.Struct("<d")
+_DOC_EDIT = struct.Struct("<II")
+_DOC_STATE_HEAD = struct.Struct("<BIIH")
+
+
+def _f64_array(frame, offset, n):
+    values = array("d")
+    values.frombytes(frame[offset:offset + 8 * n])
+    if len(values) != n:
+        raise ValueError("обрезанный кадр")
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values.tolist()
+
+
+def _f64_bytes(values):
+    values = array("d", values)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values.tobytes()
+
+
+def select_subprotocol(connection, subprotocols):
+    """Бинарный протокол — только по запросу клиента; без него остаётся JSON"""
+    return SUBPROTOCOL if SUBPROTOCOL in subprotocols else None
+
+
+def decode_request(frame):
+    """Бинарный кадр -> словарь запроса в том же виде, что и JSON-запрос"""
+    if not frame:
+        raise ValueError("пустой кадр")
+    kind = frame[0]
+    if kind == REQ_SET_AB:
+        a, b = _AB.unpack_from(frame, 1)
+        return {"type": "set_ab", "a": a, "b": b}
+    if kind == REQ_GET_STATE:
+        return {"type": "get_state"}
+    if kind == REQ_CALCULATE:
+        op, a, b = _CALC.unpack_from(frame, 1)
+        return {"type": "calculate", "operation": op.decode("ascii"), "a": a, "b": b}
+    if kind == REQ_CALCULATE_BATCH:
+        (n,) = _U32.unpack_from(frame, 1)
+        ops = frame[5:5 + n].decode("ascii")
+        a = _f64_array(frame, 5 + n, n)
+        b = _f64_array(frame, 5 + 9 * n, n)
+        return {"type": "calculate_batch", "operations": list(ops), "a": a, "b": b}
+    if kind == REQ_TEXT:
+        return {"text": bytes(frame[1:]).decode("utf-8")}
+    if kind == REQ_RESTORE:
+        return {"type": "restore"}
+    if kind == REQ_TEXT_BEGIN:
+        return {"type": "text_begin"}
+    if kind == REQ_TEXT_CHUNK:
+        # не декодируем: граница кадра может пройти посреди символа
+        return {"type": "text_chunk", "text": frame[1:]}
+    if kind == REQ_TEXT_END:
+        return {"type": "text_end"}
+    if kind == REQ_ANALYZE_BATCH:
+        (n,) = _U32.unpack_from(frame, 1)
+        texts = []
+        offset = 5
+        for _ in range(n):
+            (size,) = _U32.unpack_from(frame, offset)
+            offset += 4
+            if offset + size > len(frame):
+                raise ValueError("обрезанный кадр")
+            texts.append(bytes(frame[offset:offset + size]).decode("utf-8"))
+            offset += size
+        return {"type": "analyze_batch", "texts": texts}
+    if kind == REQ_DOC_OPEN:
+        return {"type": "doc_open", "text": bytes(frame[1:]).decode("utf-8")}
+    if kind == REQ_DOC_EDIT:
+        offset, delete = _DOC_EDIT.unpack_from(frame, 1)
+        insert = bytes(frame[1 + _DOC_EDIT.size:]).decode("utf-8")
+        return {"type": "doc_edit", "ops": [{"op": "replace", "offset": offset, "length": delete, "text": insert}]}
+    if kind == REQ_DOC_CLOSE:
+        return {"type": "doc_close"}
+    raise ValueError(f"неизвестный тип кадра: {kind:#x}")
+
+
+def _timestamp(updated_at):
+    if not updated_at:
+        return math.nan
+    return datetime.fromisoformat(updated_at).timestamp()
+
+
+def _analysis(kind, message):
+    hist = message.get("length_hist") or {}
+    parts = [_HIST_HEAD.pack(kind, message.get("word_count", 0), _timestamp(message.get("updated_at")), len(hist))]
+    parts.extend(_HIST_ITEM.pack(int(length), count) for length, count in hist.items())
+    if kind == RESP_RESTORE:
+        original = (message.get("original") or "").encode("utf-8")
+        parts.append(_U32.pack(len(original)))
+        parts.append(original)
+    return b"".join(parts)
+
+
+def with_updated_at(frame, updated_at):
+    """Копия кадра RESULT/RESTORE/PARTIAL с другим updated_at"""
+    frame = bytearray(frame)
+    _F64.pack_into(frame, 5, _timestamp(updated_at))
+    return bytes(frame)
+
+
+def encode_response(message):
+    """Словарь ответа сервера -> бинарный кадр"""
+    kind = message.get("type")
+    if kind == "state":
+        return _TYPE_DD.pack(RESP_STATE, message["a"], message["b"])
+    if kind == "calculation_result":
+        return _TYPE_F64.pack(RESP_CALC_RESULT, message["result"])
+    if kind == "calculation_error":
+        return _TYPE_CODE.pack(RESP_CALC_ERROR, message.get("code", ERR_BAD_REQUEST))
+    if kind == "calculation_batch_result":
+        results = message["results"]
+        errors = message["errors"]
+        return b"".join([
+            bytes([RESP_CALC_BATCH]),
+            _U32.pack(len(results)),
+            _f64_bytes([math.nan if r is None else r for r in results]),
+            _U32.pack(len(errors)),
+            *(_BATCH_ERR.pack(e["index"], e["code"]) for e in errors),
+        ])
+    if kind == "result":
+        return _analysis(RESP_RESULT, message)
+    if kind == "restore":
+        return _analysis(RESP_RESTORE, message)
+    if kind == "partial":
+        return _analysis(RESP_PARTIAL, message)
+    if kind == "doc_state":
+        hist = message["length_hist"]
+        return b"".join([
+            _DOC_STATE_HEAD.pack(RESP_DOC_STATE, message["version"], message["word_count"], len(hist)),
+            *(_HIST_ITEM.pack(int(length), count) for length, count in hist.items()),
+        ])
+    if kind in ("history", "stats"):
+        return bytes([RESP_JSON]) + json.dumps(message, ensure_ascii=False).encode("utf-8")
+    if kind == "batch_result":
+        parts = [bytes([RESP_BATCH_RESULT]), _U32.pack(len(message["results"]))]
+        for doc in message["results"]:
+            hist = doc["length_hist"]
+            parts.append(_DOC_HEAD.pack(doc["word_count"], len(hist)))
+            parts.extend(_HIST_ITEM.pack(int(length), count) for length, count in hist.items())
+        return b"".join(parts)
+    return _TYPE_CODE.pack(RESP_ERROR, message.get("code", ERR_BAD_REQUEST))
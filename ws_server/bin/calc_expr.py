@@ -0,0 +1,119 @@
+import ast
+import math
+import os
+from functools import lru_cache
+
+# Компилированные выражения храним в LRU по тексту выражения
+EXPR_CACHE_SIZE = int(os.environ.get("EXPR_CACHE_SIZE", "1024"))
+MAX_EXPR_LEN = 256
+
+# Функции и константы, доступные в выражениях; всё остальное — переменные
+FUNCS = {
+    "sqrt": math.sqrt,
+    "pow": math.pow,
+    "abs": abs,
+    "min": min,
+    "max": max,
+    "round": round,
+    "exp": math.exp,
+    "log": math.log,
+    "sin": math.sin,
+    "cos": math.cos,
+    "tan": math.tan,
+}
+CONSTS = {"pi": math.pi, "e": math.e}
+
+_BIN_OPS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Mod, ast.Pow)
+_UNARY_OPS = (ast.UAdd, ast.USub)
+
+
+class ExpressionError(ValueError):
+    pass
+
+
+class _Validator(ast.NodeTransformer):
+    """Пропускает только арифметику, числа, переменные и вызовы из FUNCS.
+
+    Числа приводятся к float, а ** заменяется на math.pow, чтобы
+    огромные степени давали OverflowError, а не считались минутами.
+    """
+
+    def __init__(self):
+        self.variables = set()
+
+    def visit_Expression(self, node):
+        node.body = self.visit(node.body)
+        return node
+
+    def visit_BinOp(self, node):
+        if not isinstance(node.op, _BIN_OPS):
+            raise ExpressionError(f"недопустимый оператор: {type(node.op).__name__}")
+        node.left = self.visit(node.left)
+        node.right = self.visit(node.right)
+        if isinstance(node.op, ast.Pow):
+            return ast.copy_location(
+                ast.Call(func=ast.Name(id="pow", ctx=ast.Load()), args=[node.left, node.right], keywords=[]),
+                node,
+            )
+        return node
+
+    def visit_UnaryOp(self, node):
+        if not isinstance(node.op, _UNARY_OPS):
+            raise ExpressionError(f"недопустимый оператор: {type(node.op).__name__}")
+        node.operand = self.visit(node.operand)
+        return node
+
+    def visit_Constant(self, node):
+        if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+            raise ExpressionError(f"недопустимая константа: {node.value!r}")
+        node.value = float(node.value)
+        return node
+
+    def visit_Name(self, node):
+        if node.id in FUNCS:
+            raise ExpressionError(f"{node.id} — функция, а не переменная")
+        if node.id not in CONSTS:
+            self.variables.add(node.id)
+        return node
+
+    def visit_Call(self, node):
+        if not isinstance(node.func, ast.Name) or node.func.id not in FUNCS or node.keywords:
+            raise ExpressionError("недопустимый вызов функции")
+        node.args = [self.visit(arg) for arg in node.args]
+        return node
+
+    def generic_visit(self, node):
+        raise ExpressionError(f"недопустимая конструкция: {type(node).__name__}")
+
+
+class CompiledExpression:
+    """Проверенное выражение, скомпилированное в байткод Python"""
+
+    def __init__(self, text, code, variables):
+        self.text = text
+        self.code = code
+        self.variables = frozenset(variables)
+
+    def __call__(self, variables):
+        missing = self.variables.difference(variables)
+        if missing:
+            raise ExpressionError(f"не заданы переменные: {', '.join(sorted(missing))}")
+        result = float(eval(self.code, {"__builtins__": {}, **FUNCS, **CONSTS}, variables))
+        # inf/nan (например, 1e300 * 1e300) в JSON не передать
+        if not math.isfinite(result):
+            raise OverflowError("результат вне диапазона float")
+        return result
+
+
+@lru_cache(maxsize=EXPR_CACHE_SIZE)
+def compile_expression(text):
+    """Разбирает и компилирует выражение; повторные вызовы берутся из LRU-кэша"""
+    if len(text) > MAX_EXPR_LEN:
+        raise ExpressionError(f"выражение длиннее {MAX_EXPR_LEN} символов")
+    try:
+        tree = ast.parse(text.strip(), mode="eval")
+    except SyntaxError as e:
+        raise ExpressionError(f"синтаксическая ошибка: {e.msg}") from None
+    validator = _Validator()
+    tree = ast.fix_missing_locations(validator.visit(tree))
+    return CompiledExpression(text, compile(tree, "<expr>", "eval"), validator.variables)
@@ -0,0 +1,214 @@
+"""История результатов анализа server2.py в SQLite (WAL).
+
+Каждый результат — одна строка, запись только добавлением. append()
+лишь кладёт запись в буфер, фоновая задача сбрасывает буфер пачкой в
+одной транзакции (один fsync на пачку) раз в flush_interval секунд или
+по накоплении flush_max записей. База обслуживается в отдельном потоке.
+
+Размер ограничен политикой хранения: не больше max_rows последних
+записей и не старше max_age секунд; освобождённые страницы отдаются
+системе через incremental_vacuum, WAL усекается чекпойнтом.
+"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import metrics
+
+HISTORY_DB = os.environ.get("HISTORY_DB", "history.db")
+HISTORY_FLUSH_INTERVAL = float(os.environ.get("HISTORY_FLUSH_INTERVAL", "0.5"))
+HISTORY_FLUSH_MAX = int(os.environ.get("HISTORY_FLUSH_MAX", "500"))
+HISTORY_MAX_ROWS = int(os.environ.get("HISTORY_MAX_ROWS", "100000"))
+HISTORY_MAX_AGE = float(os.environ.get("HISTORY_MAX_AGE_DAYS", "30")) * 86400
+# Чистка по политике хранения — не чаще, чем раз в столько секунд
+HISTORY_PRUNE_INTERVAL = float(os.environ.get("HISTORY_PRUNE_INTERVAL", "60"))
+# Максимум записей на страницу ответа history
+HISTORY_PAGE_MAX = 100
+
+log = logging.getLogger("history")
+
+
+def _timestamp(value):
+    """ISO-строка или число секунд -> число секунд (None остаётся None)"""
+    if value is None or isinstance(value, (int, float)):
+        return value
+    return datetime.fromisoformat(value).timestamp()
+
+
+class HistoryStore:
+    def __init__(
+        self,
+        path=HISTORY_DB,
+        flush_interval=HISTORY_FLUSH_INTERVAL,
+        flush_max=HISTORY_FLUSH_MAX,
+        max_rows=HISTORY_MAX_ROWS,
+        max_age=HISTORY_MAX_AGE,
+    ):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_max = flush_max
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.pending = []
+        self.last_prune = 0.0
+        self._db = None
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history-db")
+
+    def _connect(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            # auto_vacuum действует, только если задан до создания таблиц
+            self._db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS history ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, ts REAL NOT NULL, "
+                "word_count INTEGER NOT NULL, length_hist TEXT NOT NULL, original TEXT NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS history_ts ON history (ts)")
+        return self._db
+
+    def _run(self, fn, *args):
+        return asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    @staticmethod
+    def _item(row, with_text):
+        item = {
+            "id": row[0],
+            "updated_at": datetime.fromtimestamp(row[1]).isoformat(timespec="seconds"),
+            "word_count": row[2],
+            "length_hist": json.loads(row[3]),
+        }
+        if with_text:
+            item["original"] = row[4]
+        return item
+
+    def _write(self, batch):
+        db = self._connect()
+        with db:
+            db.executemany(
+                "INSERT INTO history (ts, word_count, length_hist, original) VALUES (?, ?, ?, ?)",
+                batch,
+            )
+
+    def _latest(self):
+        row = self._connect().execute(
+            "SELECT id, ts, word_count, length_hist, original FROM history ORDER BY id DESC LIMIT 1"
+        ).fetchone()
+        return self._item(row, True) if row else None
+
+    def _query(self, before_id, since, until, limit, with_text):
+        where, args = [], []
+        if before_id is not None:
+            where.append("id < ?")
+            args.append(before_id)
+        if since is not None:
+            where.append("ts >= ?")
+            args.append(since)
+        if until is not None:
+            where.append("ts < ?")
+            args.append(until)
+        columns = "id, ts, word_count, length_hist, " + ("original" if with_text else "NULL")
+        sql = f"SELECT {columns} FROM history"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY id DESC LIMIT ?"
+        rows = self._connect().execute(sql, (*args, limit + 1)).fetchall()
+        items = [self._item(row, with_text) for row in rows[:limit]]
+        # курсор следующей страницы: id последней отданной записи
+        return items, (items[-1]["id"] if len(rows) > limit else None)
+
+    def _prune(self):
+        db = self._connect()
+        with db:
+            removed = 0
+            if self.max_rows:
+                removed += db.execute(
+                    "DELETE FROM history WHERE id <= (SELECT MAX(id) FROM history) - ?", (self.max_rows,)
+                ).rowcount
+            if self.max_age:
+                removed += db.execute("DELETE FROM history WHERE ts < ?", (time.time() - self.max_age,)).rowcount
+        if removed:
+            db.execute("PRAGMA incremental_vacuum").fetchall()
+            db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return removed
+
+    async def start(self):
+        """Запускает фоновый сброс; возвращает последнюю запись (для restore)"""
+        latest = await self._run(self._latest)
+        self._task = asyncio.create_task(self._loop())
+        return latest
+
+    def append(self, message, ts=None):
+        """Добавляет результат ({"original", "word_count", "length_hist", "updated_at"}).
+
+        ts — время записи для политики хранения, по умолчанию updated_at.
+        """
+        ts = ts or _timestamp(message.get("updated_at")) or time.time()
+        self.pending.append(
+            (ts, message.get("word_count", 0), json.dumps(message.get("length_hist", {})), message.get("original", ""))
+        )
+        if len(self.pending) >= self.flush_max:
+            self._wakeup.set()
+
+    async def flush(self):
+        async with self._lock:
+            if self.pending:
+                batch, self.pending = self.pending, []
+                try:
+                    with metrics.Timer("persist_seconds", "history"):
+                        await self._run(self._write, batch)
+                    metrics.inc("history_appended_total", value=len(batch))
+                except Exception as e:
+                    # вернём пачку в начало буфера — попробуем на следующем тике
+                    self.pending[:0] = batch
+                    log.warning("Failed to append history: %s", e)
+            now = time.monotonic()
+            if now - self.last_prune >= HISTORY_PRUNE_INTERVAL:
+                self.last_prune = now
+                try:
+                    removed = await self._run(self._prune)
+                    if removed:
+                        metrics.inc("history_pruned_total", value=removed)
+                        log.info("History pruned: %d rows", removed)
+                except Exception as e:
+                    log.warning("Failed to prune history: %s", e)
+
+    async def query(self, before_id=None, since=None, until=None, limit=20, with_text=False):
+        """Страница истории от новых к старым: (записи, before_id следующей страницы или None)"""
+        await self.flush()
+        limit = max(1, min(int(limit), HISTORY_PAGE_MAX))
+        before_id = None if before_id is None else int(before_id)
+        return await self._run(self._query, before_id, _timestamp(since), _timestamp(until), limit, bool(with_text))
+
+    async def _loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def close(self):
+        """Останавливает фоновую задачу, дописывает буфер и закрывает базу"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        if self._db is not None:
+            await self._run(self._db.close)
+        self._executor.shutdown()
@@ -0,0 +1,168 @@
+"""Метрики WebSocket-серверов: счётчики, гистограммы задержек и gauge.
+
+Снимаются по HTTP в формате Prometheus (METRICS_PORT, любой путь)
+и/или периодически пишутся в лог одной JSON-строкой (METRICS_DUMP_INTERVAL
+секунд). В многопроцессном режиме каждый воркер считает своё, а в
+выдаче есть pid, чтобы различать воркеров.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from bisect import bisect_left
+
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_DUMP_INTERVAL = float(os.environ.get("METRICS_DUMP_INTERVAL", "0"))
+
+# Границы корзин гистограмм, секунды
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+log = logging.getLogger("metrics")
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Оценка квантиля по корзинам (верхняя граница корзины)"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                return BUCKETS[i] if i < len(BUCKETS) else float("inf")
+        return float("inf")
+
+
+counters = {}
+histograms = {}
+gauges = {}
+
+
+def inc(name, label=None, value=1):
+    key = (name, label)
+    counters[key] = counters.get(key, 0) + value
+
+
+def observe(name, label, seconds):
+    key = (name, label)
+    hist = histograms.get(key)
+    if hist is None:
+        hist = histograms[key] = Histogram()
+    hist.observe(seconds)
+
+
+def gauge(name, fn):
+    """Регистрирует gauge: fn() вызывается в момент снятия метрик"""
+    gauges[name] = fn
+
+
+def _labels(label, **extra):
+    items = {"pid": os.getpid()}
+    if label is not None:
+        items["type"] = label
+    items.update(extra)
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items.items()) + "}"
+
+
+def render():
+    """Все метрики в текстовом формате Prometheus"""
+    lines = []
+    for (name, label), value in sorted(counters.items(), key=lambda kv: (kv[0][0], str(kv[0][1]))):
+        lines.append(f"{name}{_labels(label)} {value}")
+    for name, fn in sorted(gauges.items()):
+        lines.append(f"{name}{_labels(None)} {fn()}")
+    for (name, label), hist in sorted(histograms.items(), key=lambda kv: (kv[0][0], str(kv[0][1]))):
+        cumulative = 0
+        for bound, c in zip((*BUCKETS, "+Inf"), hist.counts):
+            cumulative += c
+            lines.append(f"{name}_bucket{_labels(label, le=bound)} {cumulative}")
+        lines.append(f"{name}_sum{_labels(label)} {hist.sum}")
+        lines.append(f"{name}_count{_labels(label)} {hist.count}")
+    return "\n".join(lines) + "\n"
+
+
+def snapshot():
+    """Компактная сводка: счётчики, gauge и p50/p99 гистограмм"""
+    def key(name, label):
+        return name if label is None else f"{name}:{label}"
+
+    data = {"pid": os.getpid()}
+    data.update({key(n, l): v for (n, l), v in counters.items()})
+    data.update({name: fn() for name, fn in gauges.items()})
+    for (name, label), hist in histograms.items():
+        data[key(name, label)] = {
+            "count": hist.count,
+            "p50": hist.quantile(0.5),
+            "p99": hist.quantile(0.99),
+        }
+    return data
+
+
+async def _handle_http(reader, writer):
+    try:
+        # запрос не разбираем: на любой путь отдаём метрики
+        await reader.readuntil(b"\r\n\r\n")
+        body = render().encode()
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            b"Content-Length: " + str(len(body)).encode() + b"\r\nConnection: close\r\n\r\n" + body
+        )
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def _dump_loop(interval):
+    while True:
+        await asyncio.sleep(interval)
+        data = snapshot()
+        log.info("metrics %s", json.dumps(data, default=str), extra={"msg_type": "metrics", "fields": data})
+
+
+_running = []
+
+
+async def start(reuse_port=False):
+    """Запускает HTTP-эндпоинт и/или периодический дамп, если они включены"""
+    if METRICS_PORT:
+        server = await asyncio.start_server(
+            _handle_http, METRICS_HOST, METRICS_PORT, reuse_port=reuse_port or None
+        )
+        _running.append(server)
+        log.info("Metrics on http://%s:%d/metrics", METRICS_HOST, METRICS_PORT)
+    if METRICS_DUMP_INTERVAL > 0:
+        _running.append(asyncio.create_task(_dump_loop(METRICS_DUMP_INTERVAL)))
+
+
+class Timer:
+    """with metrics.Timer("persist_seconds", "sessions"): ..."""
+
+    __slots__ = ("name", "label", "started")
+
+    def __init__(self, name, label=None):
+        self.name = name
+        self.label = label
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, self.label, time.perf_counter() - self.started)
@@ -0,0 +1,64 @@
+"""Пул процессов для тяжёлых вычислений, чтобы они не блокировали event loop.
+
+Очередь ограничена: если задач (в работе и в ожидании) уже limit, новая
+сразу отклоняется с PoolBusy — клиенту лучше быстро получить отказ, чем
+ждать за чужими мегабайтами. Задачу можно отменить (например, клиент
+отключился): ещё не начатая задача снимается с очереди, у уже
+выполняющейся результат просто выбрасывается.
+"""
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+
+class PoolBusy(Exception):
+    pass
+
+
+class OffloadPool:
+    def __init__(self, processes=None, limit=None):
+        self.processes = processes or os.cpu_count() or 1
+        self.limit = limit or self.processes * 2
+        self.pending = 0
+        self.executor = None
+
+    def start(self):
+        """Создаёт процессы; вызывать уже в воркере (после prefork.run)"""
+        if self.executor is None:
+            # spawn: дочерние процессы не наследуют потоки и event loop родителя
+            self.executor = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context("spawn"))
+
+    async def run(self, fn, *args, cancel_on=None):
+        """Выполняет fn(*args) в пуле; отменяет задачу, если раньше завершится cancel_on().
+
+        Возвращает результат fn или None, если задача отменена.
+        """
+        if self.pending >= self.limit:
+            raise PoolBusy()
+        self.start()
+        self.pending += 1
+        try:
+            job = asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+            if cancel_on is None:
+                return await job
+            watcher = asyncio.ensure_future(cancel_on())
+            try:
+                await asyncio.wait((job, watcher), return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                watcher.cancel()
+                if not job.done():
+                    job.cancel()
+            return None if job.cancelled() else job.result()
+        finally:
+            self.pending -= 1
+
+    def close(self):
+        """Останавливает процессы и дожидается их выхода.
+
+        Воркер prefork завершается через os._exit, минуя atexit, поэтому
+        без ожидания здесь процессы пула и их семафоры остались бы висеть.
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
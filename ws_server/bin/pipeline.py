@@ -0,0 +1,96 @@
+"""Конвейерная обработка сообщений одного соединения (server.py, server2.py).
+
+Сообщения читаются из сокета по очереди, а обрабатываются задачами — до
+PIPELINE_WINDOW сообщений соединения одновременно. Когда окно заполнено,
+сервер перестаёт читать сокет, и клиента притормаживает TCP.
+
+Порядок задаётся полосами (lanes): задача начинается только после того,
+как завершились предыдущие задачи тех же полос. Сообщения без поля "id"
+(а значит, и все бинарные кадры — в них id нет) идут в полосе ORDERED:
+между собой они по-прежнему обрабатываются строго по очереди, и ответы
+на них приходят в порядке запросов. Сообщения с "id" обрабатываются
+параллельно, ответы на них приходят в любом порядке и несут тот же
+"id". Сервер добавляет свои полосы там, где порядок важен по смыслу
+(одна сессия в server.py, поток текста и документ в server2.py).
+"""
+import asyncio
+import json
+import logging
+import os
+
+from websockets.exceptions import ConnectionClosed
+
+PIPELINE_WINDOW = max(1, int(os.environ.get("PIPELINE_WINDOW", "32")))
+# Полоса сообщений без id
+ORDERED = object()
+
+log = logging.getLogger("pipeline")
+
+
+def request_id(message):
+    """id из сырого JSON-сообщения, например для отказа без обработки; None, если его нет.
+
+    Сообщение разбирается, только если в нём вообще встречается "id".
+    """
+    if isinstance(message, str) and '"id"' in message:
+        try:
+            data = json.loads(message)
+        except ValueError:
+            return None
+        return data.get("id") if isinstance(data, dict) else None
+    return None
+
+
+def with_id(message, rid):
+    """Ответ-словарь с id запроса"""
+    return message if rid is None else {**message, "id": rid}
+
+
+def with_id_encoded(data, rid):
+    """То же для готового JSON-ответа (str или bytes): id дописывается в конец объекта"""
+    if rid is None:
+        return data
+    tail = ', "id": ' + json.dumps(rid, ensure_ascii=False) + "}"
+    if isinstance(data, bytes):
+        return data[:-1] + tail.encode("utf-8")
+    return data[:-1] + tail
+
+
+class Pipeline:
+    def __init__(self, window=PIPELINE_WINDOW):
+        self.window = asyncio.Semaphore(window)
+        self.tails = {}  # полоса -> последняя задача в ней
+        self.tasks = set()
+
+    async def submit(self, lanes, fn, *args):
+        """Ставит fn(*args) после задач тех же полос; ждёт, пока в окне освободится место"""
+        await self.window.acquire()
+        after = [self.tails[lane] for lane in lanes if lane in self.tails]
+        task = asyncio.create_task(self._run(after, fn, args))
+        for lane in lanes:
+            self.tails[lane] = task
+        self.tasks.add(task)
+        task.add_done_callback(lambda t: self._finished(t, lanes))
+
+    def _finished(self, task, lanes):
+        self.tasks.discard(task)
+        self.window.release()
+        for lane in lanes:
+            if self.tails.get(lane) is task:
+                del self.tails[lane]
+
+    @staticmethod
+    async def _run(after, fn, args):
+        if after:
+            await asyncio.wait(after)
+        try:
+            await fn(*args)
+        except ConnectionClosed:
+            pass
+        except Exception:
+            log.exception("Message handler failed")
+
+    async def close(self):
+        """Дожидается уже принятых сообщений"""
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
@@ -0,0 +1,136 @@
+import asyncio
+import mmap
+import multiprocessing
+import os
+import signal
+import socket
+import struct
+import traceback
+import zlib
+
+# Количество процессов-воркеров на одном порту (SO_REUSEPORT); 1 — обычный режим
+WORKERS = int(os.environ.get("WORKERS", "1"))
+
+
+def enabled(workers=WORKERS):
+    """Многопроцессный режим возможен только там, где есть fork и SO_REUSEPORT"""
+    return workers > 1 and hasattr(os, "fork") and hasattr(socket, "SO_REUSEPORT")
+
+
+def run(main, workers=WORKERS):
+    """Запускает asyncio-сервер main() в workers дочерних процессах.
+
+    Каждый воркер сам слушает тот же порт с reuse_port=True, ядро
+    распределяет соединения между ними. Родитель только ждёт детей
+    и пересылает им SIGINT/SIGTERM.
+    """
+    if not enabled(workers):
+        asyncio.run(main())
+        return
+
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                asyncio.run(main())
+            except KeyboardInterrupt:
+                pass
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        children.append(pid)
+    print(f"Started {workers} workers: {children}")
+
+    def forward(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, forward)
+    signal.signal(signal.SIGTERM, forward)
+    for pid in children:
+        try:
+            os.waitpid(pid, 0)
+        except ChildProcessError:
+            pass
+
+
+class SharedVersions:
+    """Счётчики версий в общей памяти, общие для всех воркеров.
+
+    Ключ хэшируется в один из slots слотов. Писатель увеличивает счётчик
+    после того, как данные попали в общее хранилище; читатель запоминает
+    счётчик до чтения и считает свою копию устаревшей, когда он изменился.
+    Гонки при инкременте не страшны: любое изменение значения — это промах.
+    """
+
+    def __init__(self, slots=65536):
+        self.counters = multiprocessing.RawArray("Q", slots)
+
+    def _slot(self, key):
+        return zlib.crc32(key.encode()) % len(self.counters)
+
+    def get(self, key):
+        return self.counters[self._slot(key)]
+
+    def bump(self, key):
+        slot = self._slot(key)
+        self.counters[slot] = (self.counters[slot] + 1) & 0xFFFFFFFFFFFFFFFF
+
+
+class SharedSnapshot:
+    """Последний снимок (bytes) в общей памяти.
+
+    Запись под межпроцессным lock, чтение без блокировок по seqlock:
+    нечётный seq — идёт запись, читатель повторяет попытку, а после
+    READ_RETRIES неудачных попыток читает под тем же lock. Память
+    анонимного mmap выделяется по мере записи, так что capacity можно
+    брать с запасом.
+    """
+
+    _HEADER = struct.Struct("QI")
+    READ_RETRIES = 100
+
+    def __init__(self, capacity=1 << 20):
+        self.capacity = capacity
+        self.buf = mmap.mmap(-1, self._HEADER.size + capacity)
+        self.lock = multiprocessing.Lock()
+
+    @property
+    def version(self):
+        return self._HEADER.unpack_from(self.buf, 0)[0]
+
+    def write(self, data):
+        """Публикует снимок и возвращает его версию; слишком большой снимок не пишется (None).
+
+        Версию нужно брать отсюда, а не из version после записи: к тому
+        времени снимок мог уже обновить другой процесс.
+        """
+        if len(data) > self.capacity:
+            return None
+        with self.lock:
+            seq = self.version
+            self._HEADER.pack_into(self.buf, 0, seq + 1, 0)
+            self.buf[self._HEADER.size:self._HEADER.size + len(data)] = data
+            self._HEADER.pack_into(self.buf, 0, seq + 2, len(data))
+        return seq + 2
+
+    def read(self):
+        """Возвращает (version, data); version == 0 — снимок ещё не публиковался"""
+        for _ in range(self.READ_RETRIES):
+            seq, size = self._HEADER.unpack_from(self.buf, 0)
+            if not seq % 2:
+                data = self.buf[self._HEADER.size:self._HEADER.size + size]
+                if self._HEADER.unpack_from(self.buf, 0)[0] == seq:
+                    return seq, data
+            # писатель держит снимок — уступаем ему процессор
+            os.sched_yield()
+        with self.lock:
+            seq, size = self._HEADER.unpack_from(self.buf, 0)
+            return seq, self.buf[self._HEADER.size:self._HEADER.size + size]
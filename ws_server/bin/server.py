@@ -1,12 +1,51 @@
 import asyncio
 import json
+import logging
+import math
+import operator
 import os
+import signal
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
 import websockets
 
-STATE_FILE = "state.json"
+import binproto
+import metrics
+import prefork
+import wslog
+from admission import Admission
+from calc_expr import ExpressionError, compile_expression
+from pipeline import ORDERED, Pipeline, request_id, with_id, with_id_encoded
 
-# Глобальное состояние (одно на сервер)
-state = {"a": 0.0, "b": 0.0}
+try:
+    import numpy as np
+except ImportError:  # numpy не обязателен — без него батч считается в чистом Python
+    np = None
+
+# Состояния a/b по сессиям лежат в SQLite; в памяти держим не больше SESSION_CACHE_SIZE сессий
+SESSIONS_DB = os.environ.get("SESSIONS_DB", "sessions.db")
+SESSION_CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", "10000"))
+DEFAULT_SESSION = "default"
+MAX_SESSION_LEN = 128
+# Типы сообщений для меток метрик; всё остальное считается как "other"
+MESSAGE_TYPES = {"set_ab", "get_state", "calculate", "calculate_batch"}
+# Отложенная запись состояния: сбрасываем на диск не чаще раза в SAVE_INTERVAL секунд
+# или сразу, если накопилось SAVE_MAX_CHANGES изменений
+SAVE_INTERVAL = float(os.environ.get("STATE_SAVE_INTERVAL", "1.0"))
+SAVE_MAX_CHANGES = int(os.environ.get("STATE_SAVE_MAX_CHANGES", "100"))
+# Рассылка изменений состояния: очередь на клиента ограничена SEND_QUEUE_SIZE сообщениями;
+# при переполнении "latest" выбрасывает самое старое сообщение, "drop" — новое
+SEND_QUEUE_SIZE = int(os.environ.get("SEND_QUEUE_SIZE", "16"))
+SEND_QUEUE_POLICY = os.environ.get("SEND_QUEUE_POLICY", "latest")
+# Многопроцессный режим: как часто проверять, не изменил ли сессии подписчиков другой воркер, секунды
+RELAY_INTERVAL = float(os.environ.get("RELAY_INTERVAL", "0.05"))
+# Сколько сообщений воркер обрабатывает одновременно (всех клиентов вместе)
+MAX_INFLIGHT = int(os.environ.get("MAX_INFLIGHT", "1000"))
+
+log = logging.getLogger("server")
 
 def to_float(v):
     if isinstance(v, (int, float)):
@@ -15,89 +54,680 @@ def to_float(v):
         return float(v.replace(",", ".").strip())
     raise ValueError("bad type")
 
-def load_state():
-    global state
-    if os.path.exists(STATE_FILE):
+# Операции калькулятора: символ -> функция над двумя числами (или векторами)
+OPS = {
+    "+": operator.add,
+    "-": operator.sub,
+    "*": operator.mul,
+    "x": operator.mul,
+    "/": operator.truediv,
+}
+
+MSG_DIV_ZERO = "Деление на ноль невозможно"
+MSG_OVERFLOW = "Результат вне диапазона чисел"
+
+def to_vector(v, n):
+    """Приводит скаляр или список к списку float длины n (скаляр размножается)"""
+    if isinstance(v, list):
+        return [to_float(x) for x in v]
+    return [to_float(v)] * n
+
+def batch_len(*values):
+    """Общая длина батча: длина первого массива среди значений (все массивы должны совпадать)"""
+    n = None
+    for v in values:
+        if isinstance(v, list):
+            if n is None:
+                n = len(v)
+            elif len(v) != n:
+                raise ValueError(f"массивы разной длины: {len(v)} != {n}")
+    return 1 if n is None else n
+
+def calculate_batch(a, b, ops):
+    """Считает a[i] ops[i] b[i] для всех i за один проход.
+
+    Возвращает (results, errors): results[i] — число или None,
+    errors — список {"index", "code", "message"} для элементов с ошибкой
+    (в том числе для результатов вне диапазона float: inf/nan).
+    """
+    n = len(a)
+    results = [None] * n
+    errors = []
+
+    # группируем индексы по операции, чтобы каждая операция считалась одним вызовом
+    groups = {}
+    for i, op in enumerate(ops):
+        groups.setdefault(op, []).append(i)
+
+    if np is not None:
+        va = np.asarray(a, dtype=float)
+        vb = np.asarray(b, dtype=float)
+    for op, idx in groups.items():
+        fn = OPS.get(op)
+        if fn is None:
+            errors.extend(
+                {"index": i, "code": binproto.ERR_UNKNOWN_OP, "message": f"Неизвестная операция: {op}"}
+                for i in idx
+            )
+            continue
+        if op == "/":
+            ok = []
+            for i in idx:
+                if b[i] == 0:
+                    errors.append({"index": i, "code": binproto.ERR_DIV_ZERO, "message": MSG_DIV_ZERO})
+                else:
+                    ok.append(i)
+            idx = ok
+        if not idx:
+            continue
+        if np is not None:
+            sel = np.asarray(idx)
+            # переполнение даёт inf/nan без предупреждений в stderr — отсеиваем ниже
+            with np.errstate(all="ignore"):
+                values = fn(va[sel], vb[sel])
+            finite = np.isfinite(values).tolist()
+            values = values.tolist()
+        else:
+            values = [fn(a[i], b[i]) for i in idx]
+            finite = [math.isfinite(r) for r in values]
+        for i, r, ok in zip(idx, values, finite):
+            if ok:
+                results[i] = r
+            else:
+                # inf/nan в JSON не передать, а в бинарном ответе NaN — это ошибка
+                errors.append({"index": i, "code": binproto.ERR_OVERFLOW, "message": MSG_OVERFLOW})
+
+    errors.sort(key=lambda e: e["index"])
+    return results, errors
+
+def calculate_expression_batch(expr, variables, n):
+    """Считает скомпилированное выражение для каждого i: variables — {имя: список длины n}.
+
+    Возвращает (results, errors) в том же виде, что и calculate_batch.
+    """
+    results = [None] * n
+    errors = []
+    names = list(variables)
+    columns = [variables[name] for name in names]
+    for i in range(n):
         try:
-            with open(STATE_FILE, "r", encoding="utf-8") as f:
-                data = json.load(f)
-            a = to_float(data.get("a", 0))
-            b = to_float(data.get("b", 0))
-            state = {"a": a, "b": b}
-            print(f"State loaded: {state}")
-        except Exception as e:
-            print(f"Failed to load state: {e}; using defaults")
-    else:
-        print("No state file; using defaults")
+            results[i] = expr(dict(zip(names, (column[i] for column in columns))))
+        except ZeroDivisionError:
+            errors.append({"index": i, "code": binproto.ERR_DIV_ZERO, "message": MSG_DIV_ZERO})
+        except (ValueError, TypeError, ArithmeticError) as e:
+            errors.append({"index": i, "code": binproto.ERR_EXPRESSION, "message": f"Ошибка в выражении: {e}"})
+    return results, errors
 
-def save_state():
-    try:
-        with open(STATE_FILE, "w", encoding="utf-8") as f:
-            json.dump(state, f, ensure_ascii=False, indent=2)
-        print(f"State saved: {state}")
-    except Exception as e:
-        print(f"Failed to save state: {e}")
+def session_key(v):
+    key = str(v)
+    if not key or len(key) > MAX_SESSION_LEN:
+        raise ValueError(f"некорректный id сессии: {key[:MAX_SESSION_LEN]}")
+    return key
+
+def session_from_request(ws):
+    """Сессия из строки подключения: ws://host:8080/?session=<id>"""
+    request = getattr(ws, "request", None)
+    path = request.path if request is not None else getattr(ws, "path", "")
+    values = parse_qs(urlsplit(path).query).get("session")
+    return session_key(values[0]) if values else DEFAULT_SESSION
+
+class SessionStore:
+    """Состояния a/b по сессиям.
+
+    В памяти — только рабочий набор (LRU на max_entries сессий), остальное
+    лениво подгружается из SQLite при первом обращении. Изменения копятся
+    в dirty и уходят на диск пачкой через StatePersister. Все обращения
+    к базе идут в отдельном потоке, event loop диск не ждёт.
+
+    В многопроцессном режиме versions — общие счётчики версий: запись из
+    другого воркера делает нашу копию устаревшей, и она перечитывается из
+    базы (задержка видимости — не больше интервала сброса у писателя).
+    Каждое изменение помечено временем put (нс), и в базе запись заменяется
+    только более новой: воркер, сбросивший старое значение позже, не затрёт
+    то, что другой воркер записал после него.
+    """
+
+    def __init__(self, path, max_entries=SESSION_CACHE_SIZE, versions=None):
+        self.path = path
+        self.versions = versions
+        self.max_entries = max_entries
+        self.cache = OrderedDict()
+        self.dirty = {}
+        self.flushing = {}
+        self._loading = {}
+        self._db = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sessions-db")
+
+    def _connect(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "id TEXT PRIMARY KEY, a REAL NOT NULL, b REAL NOT NULL, version INTEGER NOT NULL DEFAULT 0)"
+            )
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(sessions)")]
+            if "version" not in columns:  # база прежних версий
+                self._db.execute("ALTER TABLE sessions ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        return self._db
+
+    def _read(self, key):
+        row = self._connect().execute("SELECT a, b FROM sessions WHERE id = ?", (key,)).fetchone()
+        return {"a": row[0], "b": row[1]} if row else None
+
+    def _write(self, batch):
+        db = self._connect()
+        with db:
+            db.executemany(
+                "INSERT INTO sessions (id, a, b, version) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET a = excluded.a, b = excluded.b, version = excluded.version "
+                "WHERE excluded.version > sessions.version",
+                [(key, entry["a"], entry["b"], version) for key, (entry, version) in batch.items()],
+            )
+
+    def _run(self, fn, *args):
+        return asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _version(self, key):
+        return self.versions.get(key) if self.versions is not None else 0
+
+    def _pending(self, key):
+        """Изменение сессии, ещё не дошедшее до базы, или None"""
+        pending = self.dirty.get(key) or self.flushing.get(key)
+        return pending[0] if pending else None
+
+    def _remember(self, key, entry, version):
+        self.cache[key] = (entry, version)
+        self.cache.move_to_end(key)
+        if len(self.cache) > self.max_entries:
+            # несохранённые записи не теряются: они ещё лежат в dirty/flushing
+            self.cache.popitem(last=False)
+
+    async def get(self, key):
+        version = self._version(key)
+        cached = self.cache.get(key)
+        if cached is not None and cached[1] == version:
+            self.cache.move_to_end(key)
+            return cached[0]
+        entry = self._pending(key)
+        if entry is None:
+            # одновременные промахи по одной сессии читают базу один раз
+            fut = self._loading.get(key)
+            if fut is None:
+                fut = self._loading[key] = self._run(self._read, key)
+                fut.add_done_callback(lambda _: self._loading.pop(key, None))
+            entry = await fut
+            # пока читали, сессию могли обновить
+            entry = self._pending(key) or entry
+            if entry is None:
+                entry = {"a": 0.0, "b": 0.0}
+        self._remember(key, entry, version)
+        return entry
+
+    def put(self, key, entry):
+        self._remember(key, entry, self._version(key))
+        self.dirty[key] = (entry, time.time_ns())
+
+    def take_dirty(self):
+        """Забирает накопленные изменения для записи на диск"""
+        batch, self.dirty = self.dirty, {}
+        self.flushing = batch
+        return batch
+
+    async def write_batch(self, batch):
+        await self._run(self._write, batch)
+        self.flushing = {}
+        if self.versions is not None:
+            for key in batch:
+                self.versions.bump(key)
+
+    def restore_dirty(self, batch):
+        """Запись не удалась — возвращаем изменения, не затирая более свежие"""
+        for key, entry in batch.items():
+            self.dirty.setdefault(key, entry)
+        self.flushing = {}
+
+    async def close(self):
+        if self._db is not None:
+            await self._run(self._db.close)
+        self._executor.shutdown()
+
+class StatePersister:
+    """Write-behind сохранение состояния.
+
+    set_ab только помечает состояние грязным, а фоновая задача сбрасывает
+    накопленные изменения на диск — event loop не ждёт диск.
+    Пачка изменений между сбросами схлопывается в одну запись.
+    """
+
+    def __init__(self, store, interval=SAVE_INTERVAL, max_changes=SAVE_MAX_CHANGES):
+        self.store = store
+        self.interval = interval
+        self.max_changes = max_changes
+        self.changes = 0
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def mark_dirty(self):
+        self.changes += 1
+        if self.changes >= self.max_changes:
+            self._wakeup.set()
+
+    async def flush(self):
+        async with self._lock:
+            if not self.changes:
+                return
+            changes, self.changes = self.changes, 0
+            batch = self.store.take_dirty()
+            try:
+                with metrics.Timer("persist_seconds", "sessions"):
+                    await self.store.write_batch(batch)
+                metrics.inc("persisted_sessions_total", value=len(batch))
+                log.info("State saved: %d sessions (%d changes)", len(batch), changes)
+            except Exception as e:
+                # не потеряем изменения — попробуем ещё раз на следующем тике
+                self.store.restore_dirty(batch)
+                self.changes += changes
+                log.warning("Failed to save state: %s", e)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def close(self):
+        """Останавливает фоновую задачу и сбрасывает несохранённые изменения"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+store = SessionStore(SESSIONS_DB)
+persister = StatePersister(store)
+
+def is_binary(ws):
+    """Клиент договорился о бинарном подпротоколе при подключении"""
+    return ws.subprotocol == binproto.SUBPROTOCOL
+
+def encode(message, binary):
+    if binary:
+        return binproto.encode_response(message)
+    return json.dumps(message, ensure_ascii=False)
+
+class Subscriber:
+    """Подписчик рассылки: своя ограниченная очередь и задача, которая её отправляет"""
+
+    def __init__(self, ws, maxsize=SEND_QUEUE_SIZE, policy=SEND_QUEUE_POLICY):
+        self.ws = ws
+        self.binary = is_binary(ws)
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.policy = policy
+        self.dropped = 0
+        self._task = asyncio.create_task(self._pump())
+
+    def offer(self, payload):
+        """Кладёт сообщение в очередь, не дожидаясь клиента"""
+        if self.queue.full():
+            self.dropped += 1
+            metrics.inc("broadcast_dropped_total")
+            if self.policy != "latest":
+                return
+            self.queue.get_nowait()
+        self.queue.put_nowait(payload)
+
+    async def _pump(self):
+        try:
+            while True:
+                payload = await self.queue.get()
+                await self.ws.send(payload)
+        except websockets.ConnectionClosed:
+            pass
+
+    def close(self):
+        self._task.cancel()
+
+class Broadcaster:
+    """Реестр подписчиков по сессиям: сообщение сериализуется один раз
+    и раздаётся всем подписчикам сессии"""
+
+    def __init__(self):
+        self.topics = {}
+        self.last = {}  # сессия -> последнее разосланное сообщение (для relay_updates)
+
+    def subscribe(self, ws, topic):
+        sub = Subscriber(ws)
+        sub.topic = topic
+        self.topics.setdefault(topic, set()).add(sub)
+        return sub
+
+    def remember(self, topic, message):
+        """Состояние, которое подписчик topic получил напрямую, при подключении"""
+        if topic in self.topics:
+            self.last.setdefault(topic, message)
+
+    def unsubscribe(self, sub):
+        subs = self.topics.get(sub.topic)
+        if subs is not None:
+            subs.discard(sub)
+            if not subs:
+                del self.topics[sub.topic]
+                self.last.pop(sub.topic, None)
+        sub.close()
+
+    def publish(self, topic, message, exclude=None):
+        """Рассылает message подписчикам topic; каждый формат кодируется один раз.
+
+        Возвращает функцию payload(binary), чтобы отправитель переиспользовал кодировку.
+        """
+        encoded = {}
+
+        def payload(binary):
+            if binary not in encoded:
+                encoded[binary] = encode(message, binary)
+            return encoded[binary]
+
+        if topic in self.topics:
+            self.last[topic] = message
+        for sub in self.topics.get(topic, ()):
+            if sub is not exclude:
+                sub.offer(payload(sub.binary))
+        return payload
+
+broadcaster = Broadcaster()
+admission = Admission(MAX_INFLIGHT)
+
+async def relay_updates(interval=RELAY_INTERVAL):
+    """Многопроцессный режим: рассылает местным подписчикам set_ab из других воркеров.
+
+    Воркер, записавший сессию в базу, увеличивает её счётчик в
+    store.versions. Изменившаяся сессия с подписчиками перечитывается,
+    и её состояние рассылается, если оно отличается от последнего
+    разосланного (своё же изменение или коллизия счётчиков повторно
+    не уходят). Задержка — до интервала сброса у воркера-писателя.
+    """
+    seen = {}
+    while True:
+        await asyncio.sleep(interval)
+        for topic in list(broadcaster.topics):
+            version = store.versions.get(topic)
+            if seen.get(topic) == version:
+                continue
+            seen[topic] = version
+            try:
+                state = await store.get(topic)
+            except Exception as e:
+                log.warning("Failed to reload session %s: %s", topic, e)
+                continue
+            message = {"type": "state", **state}
+            if broadcaster.last.get(topic) != message:
+                broadcaster.publish(topic, message)
+        # забываем сессии, у которых не осталось подписчиков
+        for topic in seen.keys() - broadcaster.topics.keys():
+            del seen[topic]
+
+def metric_type(msg_type):
+    if msg_type is None:
+        return "invalid"
+    return msg_type if msg_type in MESSAGE_TYPES else "other"
+
+metrics.gauge("connections", lambda: sum(len(subs) for subs in broadcaster.topics.values()))
+metrics.gauge("send_queue_depth", lambda: sum(
+    sub.queue.qsize() for subs in broadcaster.topics.values() for sub in subs
+))
+metrics.gauge("session_cache_size", lambda: len(store.cache))
+metrics.gauge("log_dropped", wslog.dropped)
+metrics.gauge("inflight", lambda: admission.inflight)
 
 async def handler(ws):
+    if not admission.connect():
+        await ws.close(1013, "Too many connections, retry later")
+        return
+    try:
+        await serve_client(ws)
+    finally:
+        admission.disconnect()
+
+async def serve_client(ws):
     peer = ws.remote_address
-    print(f"Client connected: {peer}")
-    # При подключении — отправим текущее состояние
-    await ws.send(json.dumps({"type": "state", **state}, ensure_ascii=False))
+    binary = is_binary(ws)
+
+    # сессия задаётся при подключении (?session=<id>), отдельное сообщение может указать свою
+    session = session_from_request(ws)
+    log.info("Client connected: %s, session: %s%s", peer, session, ", binary" if binary else "")
+    # Сначала подписка, потом текущее состояние: set_ab, разосланный, пока читаем
+    # и отправляем состояние, всё равно дойдёт (в худшем случае — повтором)
+    sub = broadcaster.subscribe(ws, session)
+    bucket = admission.bucket()
+    pipeline = Pipeline()
+
+    async def reply(message):
+        await ws.send(encode(message, binary))
+
     try:
+        state = {"type": "state", **await store.get(session)}
+        broadcaster.remember(session, state)
+        await ws.send(encode(state, binary))
         async for message in ws:
-            print(f"recv: {message}")
+            rejected = admission.admit(bucket)
+            if rejected is not None:
+                # лишнее сообщение даже не разбираем; ответ — в свою очередь, если id нет
+                metrics.inc("messages_total", "rejected")
+                rid = None if binary else request_id(message)
+                await pipeline.submit([ORDERED] if rid is None else [], reply, with_id(rejected, rid))
+                continue
+            started = time.perf_counter()
             try:
-                data = json.loads(message)
+                if isinstance(message, bytes):
+                    data = binproto.decode_request(message)
+                else:
+                    data = json.loads(message)
                 msg_type = data.get("type")
+                key = session_key(data["session"]) if "session" in data else session
+            except Exception as e:
+                admission.release()
+                log.debug("bad message %r: %s", message, e, extra={"msg_type": "error"})
+                metrics.inc("errors_total", "invalid")
+                metrics.inc("messages_total", "invalid")
+                error = {"type": "error", "code": binproto.ERR_BAD_REQUEST, "message": f"Неверный формат/данные: {e}"}
+                await pipeline.submit([ORDERED], reply, error)
+                continue
+            metrics.observe("parse_seconds", metric_type(msg_type), time.perf_counter() - started)
+            log.debug("recv: %s", message, extra={"msg_type": "recv"})
+            # в бинарных ответах id не передать — там всё по очереди
+            rid = None if binary else data.get("id")
+            # сообщения без id — строго по очереди; всё, что читает или меняет a/b сессии, —
+            # по очереди внутри сессии (set_ab, затем get_state увидит новое состояние)
+            lanes = [ORDERED] if rid is None else []
+            if msg_type not in ("calculate", "calculate_batch") or not ("a" in data and "b" in data):
+                lanes.append(("session", key))
+            try:
+                await pipeline.submit(lanes, process, ws, sub, binary, data, key, rid)
+            except BaseException:
+                # задача не создана — process не освободит слот сам
+                admission.release()
+                raise
+    except websockets.ConnectionClosed:
+        log.info("Client disconnected: %s", peer)
+    finally:
+        await pipeline.close()
+        broadcaster.unsubscribe(sub)
 
-                if msg_type == "set_ab":
-                    # обновим и сохраним
-                    a = to_float(data.get("a", state["a"]))
-                    b = to_float(data.get("b", state["b"]))
-                    state["a"], state["b"] = a, b
-                    save_state()
-                    # ответим новым состоянием
-                    await ws.send(json.dumps({"type": "state", **state}, ensure_ascii=False))
-
-                elif msg_type == "get_state":
-                    await ws.send(json.dumps({"type": "state", **state}, ensure_ascii=False))
-
-                elif msg_type == "calculate":
-                    # разрешаем не передавать a/b — берём сохранённые
-                    a = to_float(data.get("a", state["a"]))
-                    b = to_float(data.get("b", state["b"]))
-                    op = str(data.get("operation", "+"))
-                    if op == "+":
-                        res = a + b
-                    elif op == "-":
-                        res = a - b
-                    elif op in ("*", "x"):
-                        res = a * b
-                    elif op == "/":
-                        if b == 0:
-                            await ws.send(json.dumps({"type": "calculation_error", "message": "Деление на ноль невозможно"}, ensure_ascii=False))
-                            continue
-                        res = a / b
-                    else:
-                        await ws.send(json.dumps({"type": "calculation_error", "message": f"Неизвестная операция: {op}"}, ensure_ascii=False))
-                        continue
-
-                    print(f"calc: {a} {op} {b} = {res}")
-                    await ws.send(json.dumps({"type": "calculation_result", "result": res}, ensure_ascii=False))
+async def process(ws, sub, binary, data, key, rid):
+    """Одно разобранное сообщение клиента (задача конвейера соединения)"""
+    started = time.perf_counter()
+    send_time = 0.0
+    msg_type = data.get("type")
 
-                else:
-                    await ws.send(json.dumps({"type": "error", "message": f"Неизвестный тип сообщения: {msg_type}"}, ensure_ascii=False))
+    async def send_payload(payload):
+        nonlocal send_time
+        started = time.perf_counter()
+        await ws.send(payload)
+        send_time += time.perf_counter() - started
 
-            except Exception as e:
-                await ws.send(json.dumps({"type": "error", "message": f"Неверный формат/данные: {e}"}, ensure_ascii=False))
-    except websockets.ConnectionClosed:
-        print(f"Client disconnected: {peer}")
+    async def send(message):
+        await send_payload(encode(with_id(message, rid), binary))
+
+    try:
+        state = await store.get(key)
+
+        if msg_type == "set_ab":
+            # обновим и сохраним
+            a = to_float(data.get("a", state["a"]))
+            b = to_float(data.get("b", state["b"]))
+            state = {"a": a, "b": b}
+            store.put(key, state)
+            persister.mark_dirty()
+            # разошлём новое состояние остальным клиентам сессии и ответим отправителю тем же payload
+            payload = broadcaster.publish(key, {"type": "state", **state}, exclude=sub)
+            await send_payload(with_id_encoded(payload(binary), rid))
+
+        elif msg_type == "get_state":
+            await send({"type": "state", **state})
+
+        elif msg_type == "calculate" and "expression" in data:
+            # произвольное выражение: a/b берём из сообщения или сессии, остальные — из variables
+            variables = {"a": state["a"], "b": state["b"]}
+            for name in ("a", "b"):
+                if name in data:
+                    variables[name] = to_float(data[name])
+            for name, value in (data.get("variables") or {}).items():
+                variables[str(name)] = to_float(value)
+            try:
+                expr = compile_expression(str(data["expression"]))
+                res = expr(variables)
+            except ZeroDivisionError:
+                await send({"type": "calculation_error", "code": binproto.ERR_DIV_ZERO, "message": MSG_DIV_ZERO})
+                return
+            except (ValueError, TypeError, ArithmeticError) as e:
+                await send({"type": "calculation_error", "code": binproto.ERR_EXPRESSION, "message": f"Ошибка в выражении: {e}"})
+                return
+
+            log.debug("calc: %s = %s", expr.text, res, extra={"msg_type": "calculate"})
+            await send({"type": "calculation_result", "result": res})
+
+        elif msg_type == "calculate":
+            # разрешаем не передавать a/b — берём сохранённые
+            a = to_float(data.get("a", state["a"]))
+            b = to_float(data.get("b", state["b"]))
+            op = str(data.get("operation", "+"))
+            if op == "+":
+                res = a + b
+            elif op == "-":
+                res = a - b
+            elif op in ("*", "x"):
+                res = a * b
+            elif op == "/":
+                if b == 0:
+                    await send({"type": "calculation_error", "code": binproto.ERR_DIV_ZERO, "message": MSG_DIV_ZERO})
+                    return
+                res = a / b
+            else:
+                await send({"type": "calculation_error", "code": binproto.ERR_UNKNOWN_OP, "message": f"Неизвестная операция: {op}"})
+                return
+
+            log.debug("calc: %s %s %s = %s", a, op, b, res, extra={"msg_type": "calculate"})
+            await send({"type": "calculation_result", "result": res})
+
+        elif msg_type == "calculate_batch" and "expression" in data:
+            # выражение по элементам: a, b и variables — числа или массивы одной длины
+            raw = {"a": data.get("a", state["a"]), "b": data.get("b", state["b"])}
+            for name, value in (data.get("variables") or {}).items():
+                raw[str(name)] = value
+            n = batch_len(*raw.values())
+            variables = {name: to_vector(value, n) for name, value in raw.items()}
+            try:
+                expr = compile_expression(str(data["expression"]))
+                missing = expr.variables.difference(variables)
+                if missing:
+                    raise ExpressionError(f"не заданы переменные: {', '.join(sorted(missing))}")
+            except (ValueError, ArithmeticError) as e:
+                await send({"type": "calculation_error", "code": binproto.ERR_EXPRESSION, "message": f"Ошибка в выражении: {e}"})
+                return
+            results, errors = calculate_expression_batch(expr, variables, n)
+            log.debug("calc_batch: %s x %d, %d errors", expr.text, n, len(errors), extra={"msg_type": "calculate_batch"})
+            await send({
+                "type": "calculation_batch_result",
+                "results": results,
+                "errors": errors,
+            })
+
+        elif msg_type == "calculate_batch":
+            # a/b — числа или массивы; operation — одна операция на все элементы,
+            # operations — массив операций по элементам
+            raw_a = data.get("a", state["a"])
+            raw_b = data.get("b", state["b"])
+            raw_ops = data.get("operations", data.get("operation", "+"))
+            n = batch_len(raw_a, raw_b, raw_ops)
+            a = to_vector(raw_a, n)
+            b = to_vector(raw_b, n)
+            if isinstance(raw_ops, list):
+                ops = [str(op) for op in raw_ops]
+            else:
+                ops = [str(raw_ops)] * n
+            results, errors = calculate_batch(a, b, ops)
+            log.debug("calc_batch: %d ops, %d errors", n, len(errors), extra={"msg_type": "calculate_batch"})
+            await send({
+                "type": "calculation_batch_result",
+                "results": results,
+                "errors": errors,
+            })
+
+        else:
+            await send({"type": "error", "code": binproto.ERR_UNKNOWN_TYPE, "message": f"Неизвестный тип сообщения: {msg_type}"})
+
+    except Exception as e:
+        log.debug("bad message %r: %s", data, e, extra={"msg_type": "error"})
+        metrics.inc("errors_total", metric_type(msg_type))
+        await send({"type": "error", "code": binproto.ERR_BAD_REQUEST, "message": f"Неверный формат/данные: {e}"})
+    finally:
+        admission.release()
+        label = metric_type(msg_type)
+        metrics.inc("messages_total", label)
+        metrics.observe("compute_seconds", label, time.perf_counter() - started - send_time)
+        metrics.observe("send_seconds", label, send_time)
 
 async def main():
-    load_state()
-    async with websockets.serve(handler, "0.0.0.0", 8080, max_size=2**20):
-        print("✅ WebSocket server running on ws://0.0.0.0:8080")
-        await asyncio.Future()
+    wslog.setup()
+    await metrics.start(reuse_port=prefork.enabled())
+    log.info("Sessions DB: %s", SESSIONS_DB)
+    persister.start()
+    relay_task = asyncio.create_task(relay_updates()) if store.versions is not None else None
+    loop = asyncio.get_running_loop()
+    stop = loop.create_future()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, lambda: stop.done() or stop.set_result(None))
+        except NotImplementedError:  # Windows
+            pass
+    try:
+        async with websockets.serve(
+            handler, "0.0.0.0", 8080, max_size=2**20, reuse_port=prefork.enabled(),
+            select_subprotocol=binproto.select_subprotocol, process_request=admission.process_request,
+        ):
+            log.info("✅ WebSocket server running on ws://0.0.0.0:8080 (pid %d)", os.getpid())
+            await stop
+    finally:
+        if relay_task is not None:
+            relay_task.cancel()
+        # сохраняем то, что ещё не успело уйти на диск
+        await persister.close()
+        await store.close()
+        wslog.shutdown()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if prefork.enabled():
+        store.versions = prefork.SharedVersions()
+    prefork.run(main)
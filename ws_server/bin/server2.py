@@ -1,22 +1,71 @@
 import asyncio
+import hashlib
 import json
-import re
+import logging
+import os
+import signal
+import struct
+import time
+from collections import Counter, OrderedDict
 from datetime import datetime
 from pathlib import Path
 import websockets
 from websockets.exceptions import ConnectionClosedError
 
+import binproto
+import metrics
+from admission import Admission
+from history import HistoryStore
+import prefork
+import sketches
+import textstats
+import wslog
+from offload import OffloadPool, PoolBusy
+from pipeline import ORDERED, Pipeline, request_id, with_id, with_id_encoded
+from textstream import TextStream
+
 HOST = "0.0.0.0"
 PORT = 8765
+# Прежний файл снимка: читается один раз, если история ещё пуста
 STATE_PATH = Path("state.json")
+# В многопроцессном режиме последний снимок дублируется в общей памяти,
+# чтобы воркеры не читали его с диска
+shared_snapshot = None
+# Максимальный размер одного сообщения (байт); ещё больше — через text_chunk
+MAX_MESSAGE_SIZE = int(os.environ.get("MAX_MESSAGE_SIZE", str(16 * 1024 * 1024)))
+# Тексты длиннее OFFLOAD_SIZE символов анализируются в пуле процессов,
+# короткие — прямо в обработчике
+OFFLOAD_SIZE = int(os.environ.get("ANALYZE_OFFLOAD_SIZE", str(256 * 1024)))
+# ANALYZE_PROCESSES — размер пула одного воркера; по умолчанию ядра делятся
+# между воркерами prefork, чтобы вместе их было не больше os.cpu_count()
+ANALYZE_PROCESSES = int(os.environ.get("ANALYZE_PROCESSES", "0")) or max(
+    1, (os.cpu_count() or 1) // (prefork.WORKERS if prefork.enabled() else 1)
+)
+pool = OffloadPool(
+    ANALYZE_PROCESSES,
+    int(os.environ.get("ANALYZE_QUEUE_SIZE", "0")) or None,
+)
+# Предельная длина документа живого ввода (doc_open / doc_edit), символов
+DOC_MAX_CHARS = int(os.environ.get("DOC_MAX_CHARS", str(16 * 1024 * 1024)))
+# Размер снимка в общей памяти: текст сообщения или документа, в JSON символ
+# занимает до 6 байт (\uXXXX), плюс остальные поля с запасом
+SNAPSHOT_CAPACITY = 6 * max(MAX_MESSAGE_SIZE, DOC_MAX_CHARS) + (1 << 20)
+# Кэш результатов по хэшу текста: не больше RESULT_CACHE_SIZE записей
+# и RESULT_CACHE_BYTES байт закодированных ответов; 0 — кэш выключен
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", "1024"))
+RESULT_CACHE_BYTES = int(os.environ.get("RESULT_CACHE_BYTES", str(64 * 1024 * 1024)))
+# Как часто накопленные слова сворачиваются в скетчи статистики (stats), секунды
+STATS_FOLD_INTERVAL = float(os.environ.get("STATS_FOLD_INTERVAL", "1.0"))
+# Сколько самых частых слов текста помнить в кэше результатов для stats
+STATS_DOC_TOP = 100
+# Суммарный размер сообщений (символов/байт), обрабатываемых воркером одновременно
+MAX_INFLIGHT_SIZE = int(os.environ.get("MAX_INFLIGHT_SIZE", str(64 * 1024 * 1024)))
+admission = Admission(MAX_INFLIGHT_SIZE)
+
+log = logging.getLogger("server2")
 
 def analyze_text(text: str):
-    tokens = [t for t in re.split(r"\s+", text.strip()) if t]
-    count = len(tokens)
-    length_hist = {}
-    for t in tokens:
-        l = len(t)
-        length_hist[l] = length_hist.get(l, 0) + 1
+    count, length_hist, tokens = textstats.analyze(text, keep_tokens=True)
     return {
         "type": "result",
         "original": text,
@@ -26,121 +75,709 @@ def analyze_text(text: str):
         "updated_at": datetime.now().isoformat(timespec="seconds"),
     }
 
-def log_request(client, text: str, result: dict):
-    ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    ip = None
-    port = None
-    if client is not None and isinstance(client, tuple) and len(client) >= 2:
-        ip, port = client[0], client[1]
-    tokens = result.get("tokens", [])
-    word_count = result.get("word_count", 0)
-    length_hist = result.get("length_hist", {})
-    preview = text.replace("\n", "\\n")
-    if len(preview) > 200:
-        preview = preview[:200] + "…"
-    hist_lines = []
-    for l in sorted(length_hist.keys()):
-        hist_lines.append(f"  длина {l}: {length_hist[l]}")
-    print(
-        "\n".join(
+# Сколько символов текста и слов показывать в подробном логе запроса
+LOG_PREVIEW_CHARS = 200
+LOG_TOKENS_MAX = 100
+
+class RequestLog:
+    """Подробный блок о запросе; строка собирается лениво — уже в потоке логгера.
+
+    Из текста и списка слов сразу берутся только превью и счётчики: запись
+    может долго ждать в очереди логгера, и держать в ней мегабайтный текст
+    незачем.
+    """
+
+    def __init__(self, ts, ip, port, text, result):
+        self.ts = ts
+        self.ip = ip
+        self.port = port
+        self.chars = len(text)
+        preview = text[:LOG_PREVIEW_CHARS + 1].replace("\n", "\\n")
+        if len(preview) > LOG_PREVIEW_CHARS:
+            preview = preview[:LOG_PREVIEW_CHARS] + "…"
+        self.preview = preview
+        tokens = result.get("tokens")
+        if tokens is None:
+            self.tokens = None
+        elif len(tokens) > LOG_TOKENS_MAX:
+            self.tokens = f"{tokens[:LOG_TOKENS_MAX]}… (всего {len(tokens)})"
+        else:
+            self.tokens = str(tokens)
+        self.word_count = result.get("word_count", 0)
+        self.length_hist = dict(result.get("length_hist", {}))
+
+    def __str__(self):
+        if self.tokens is None:
+            tokens_line = "Список слов: (не передаётся)"
+        else:
+            tokens_line = f"Список слов: {self.tokens}"
+        hist_lines = []
+        for l in sorted(self.length_hist.keys()):
+            hist_lines.append(f"  длина {l}: {self.length_hist[l]}")
+        return "\n".join(
             [
                 "—" * 72,
-                f"[{ts}] Запрос от {ip or '?'}:{port or '?'}",
-                f"Исходный текст ({len(text)} симв.): \"{preview}\"",
-                f"Слов: {word_count}",
-                f"Список слов: {tokens}" if tokens else "Список слов: []",
+                f"[{self.ts}] Запрос от {self.ip or '?'}:{self.port or '?'}",
+                f"Исходный текст ({self.chars} симв.): \"{self.preview}\"",
+                f"Слов: {self.word_count}",
+                tokens_line,
                 "Гистограмма длин:" if hist_lines else "Гистограмма длин: (пусто)",
                 *hist_lines,
                 "—" * 72,
             ]
         )
-    )
 
-def save_state(result: dict):
-    payload = {
+def log_request(client, text: str, result: dict):
+    if not log.isEnabledFor(logging.INFO):
+        return
+    ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    ip = None
+    port = None
+    if client is not None and isinstance(client, tuple) and len(client) >= 2:
+        ip, port = client[0], client[1]
+    fields = {
+        "client": f"{ip}:{port}",
+        "chars": len(text),
+        "word_count": result.get("word_count", 0),
+        "length_hist": result.get("length_hist", {}),
+    }
+    log.info("%s", RequestLog(ts, ip, port, text, result), extra={"msg_type": "text", "fields": fields})
+
+class SnapshotCache:
+    """Последний снимок в памяти, уже закодированный для отправки.
+
+    Обновляется в save_state, при старте берётся из истории, а в
+    многопроцессном режиме перечитывается, когда другой воркер
+    опубликовал новый снимок в shared_snapshot.
+    """
+
+    def __init__(self):
+        self.shared_version = 0
+        self.message = None
+        self.encoded = {}
+
+    def _set(self, message):
+        self.message = message
+        self.encoded = {}
+
+    def put(self, payload, data=None, version=0):
+        """version — версия этого снимка в shared_snapshot (0 — не публиковался)"""
+        self._set(payload)
+        if data is not None:
+            self.encoded[False] = data
+        self.shared_version = version
+
+    def _refresh(self):
+        if shared_snapshot is None:
+            return
+        version = shared_snapshot.version
+        if version and version != self.shared_version:
+            version, data = shared_snapshot.read()
+            self._set(json.loads(data))
+            self.encoded[False] = data
+            self.shared_version = version
+
+    def get(self):
+        """Текущий снимок (dict) или None"""
+        self._refresh()
+        return self.message
+
+    def payload(self, binary):
+        """Снимок в формате клиента; каждый формат кодируется один раз"""
+        data = self.encoded.get(binary)
+        if data is None:
+            data = self.encoded[binary] = encode_bytes(self.message, binary)
+        return data
+
+snapshot_cache = SnapshotCache()
+history = HistoryStore()
+
+def state_payload(result: dict):
+    # updated_at — последним: кэш результатов подменяет его в готовом JSON
+    return {
         "type": "restore",
         "original": result.get("original", ""),
         "word_count": result.get("word_count", 0),
         "length_hist": result.get("length_hist", {}),
         "updated_at": result.get("updated_at"),
     }
-    tokens = result.get("tokens")
-    if tokens is not None:
-        payload["tokens"] = tokens
-    STATE_PATH.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
 
-def load_state():
-    if not STATE_PATH.exists():
-        return None
-    try:
-        data = json.loads(STATE_PATH.read_text(encoding="utf-8"))
-        data["type"] = "restore"
-        return data
-    except Exception as e:
-        print(f"[WARN] Не удалось прочитать {STATE_PATH}: {e}")
+def encode_state(payload: dict):
+    return json.dumps(payload, ensure_ascii=False).encode("utf-8")
+
+def store_state(payload: dict, data: bytes):
+    """Дописывает результат в историю и делает его текущим снимком для restore"""
+    history.append(payload)
+    version = 0
+    if shared_snapshot is not None:
+        version = shared_snapshot.write(data)
+        if version is None:
+            log.warning("Snapshot of %d bytes does not fit shared memory, other workers keep the previous one", len(data))
+            version = shared_snapshot.version
+    snapshot_cache.put(payload, data, version)
+
+def save_state(result: dict):
+    """Сохраняет снимок; возвращает его JSON (для кэша результатов)"""
+    payload = state_payload(result)
+    data = encode_state(payload)
+    store_state(payload, data)
+    return data
+
+def analyze_job(text: str):
+    """Анализ и сериализация снимка в процессе пула.
+
+    Назад едут только счётчики и готовый JSON: исходный текст у
+    родителя уже есть, а список токенов не нужен.
+    """
+    result = analyze_text(text)
+    summary = {k: result[k] for k in ("type", "word_count", "length_hist", "updated_at")}
+    return summary, encode_state(state_payload(result)), sketches.summarize(result["tokens"])
+
+async def analyze_offloaded(websocket, text: str):
+    """Анализ большого текста в пуле; None — клиент отключился раньше"""
+    done = await pool.run(analyze_job, text, cancel_on=websocket.wait_closed)
+    if done is None:
+        metrics.inc("offload_cancelled_total")
         return None
+    summary, data, (common, registers) = done
+    result = dict(summary, original=text)
+    log_request(websocket.remote_address, text, result)
+    with metrics.Timer("persist_seconds", "state"):
+        store_state(state_payload(result), data)
+    # разные слова уже захэшированы в пуле — сливаем только регистры
+    corpus.distinct.merge(registers)
+    count_words(dict(common), result["length_hist"])
+    return result, data, common[:STATS_DOC_TOP]
+
+corpus = sketches.CorpusStats()
+stats_wakeup = asyncio.Event()
+stats_lock = asyncio.Lock()
+
+def count_words(words, length_hist):
+    """Учитывает текст в общей статистике; words — список слов или {слово: счёт}"""
+    corpus.add_lengths(length_hist)
+    if corpus.add_words(words):
+        stats_wakeup.set()
+
+async def fold_stats():
+    """Сворачивает накопленные слова в скетчи (хэширование — в пуле процессов)"""
+    async with stats_lock:
+        pending = corpus.take_pending()
+        if not pending:
+            return
+        try:
+            summary = await pool.run(sketches.summarize, pending)
+        except PoolBusy:
+            if len(pending) < 2 * corpus.pending_max:
+                # пул занят текстами — подождём следующего раза
+                corpus.pending.update(pending)
+                return
+            summary = sketches.summarize(pending)
+        corpus.merge(summary)
+
+async def stats_loop():
+    while True:
+        try:
+            await asyncio.wait_for(stats_wakeup.wait(), STATS_FOLD_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        stats_wakeup.clear()
+        try:
+            await fold_stats()
+        except Exception as e:
+            log.warning("Failed to update stats: %s", e)
+
+async def load_history():
+    """Последний результат из истории — текущий снимок после перезапуска.
+
+    Если история пуста, а остался state.json от прежних версий, он
+    становится её первой записью.
+    """
+    latest = await history.start()
+    if latest is None and STATE_PATH.exists():
+        try:
+            latest = json.loads(STATE_PATH.read_text(encoding="utf-8"))
+            # время импорта, а не updated_at снимка: иначе старый снимок сразу
+            # удалится по HISTORY_MAX_AGE и будет импортироваться при каждом старте
+            history.append(latest, ts=time.time())
+            log.info("Imported %s into history", STATE_PATH)
+        except Exception as e:
+            log.warning("Не удалось прочитать %s: %s", STATE_PATH, e)
+    if latest is not None:
+        payload = state_payload(latest)
+        snapshot_cache.put(payload, encode_state(payload))
+
+def client_result(result: dict):
+    return {
+        "type": "result",
+        "original": result["original"],
+        "word_count": result["word_count"],
+        "length_hist": result["length_hist"],
+        "updated_at": result["updated_at"],
+    }
+
+def split_updated_at(data: bytes, updated_at):
+    """JSON с updated_at последним полем -> (начало, конец) вокруг его значения"""
+    head, tail = data.rsplit(json.dumps(updated_at).encode("utf-8"), 1)
+    return head, tail
+
+class CachedResult:
+    """Готовые ответ и снимок для одного текста; меняется только updated_at"""
+
+    __slots__ = ("word_count", "length_hist", "words", "response", "binary", "state", "size")
+
+    def __init__(self, result, state_data, words):
+        updated_at = result["updated_at"]
+        message = client_result(result)
+        self.word_count = result["word_count"]
+        self.length_hist = result["length_hist"]
+        self.words = dict(words)  # самые частые слова — для stats при попадании в кэш
+        self.response = split_updated_at(encode_bytes(message, False), updated_at)
+        self.binary = binproto.encode_response(message)
+        self.state = split_updated_at(state_data, updated_at)
+        self.size = (
+            sum(map(len, self.response)) + len(self.binary) + sum(map(len, self.state)) + sum(map(len, self.words))
+        )
+
+    def payload(self, binary, updated_at):
+        if binary:
+            return binproto.with_updated_at(self.binary, updated_at)
+        head, tail = self.response
+        return head + json.dumps(updated_at).encode("utf-8") + tail
+
+    def store(self, text, updated_at):
+        head, tail = self.state
+        data = head + json.dumps(updated_at).encode("utf-8") + tail
+        message = {
+            "type": "restore",
+            "original": text,
+            "word_count": self.word_count,
+            "length_hist": self.length_hist,
+            "updated_at": updated_at,
+        }
+        store_state(message, data)
+
+class ResultCache:
+    """LRU по хэшу текста с ограничением по числу записей и по байтам"""
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+
+    @staticmethod
+    def key(text):
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            metrics.inc("result_cache_misses_total")
+            return None
+        self.entries.move_to_end(key)
+        metrics.inc("result_cache_hits_total")
+        return entry
+
+    def put(self, key, entry):
+        # одна запись не должна вытеснять весь кэш
+        if not self.max_entries or entry.size > self.max_bytes // 4:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= old.size
+        self.entries[key] = entry
+        self.size += entry.size
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.size
+
+result_cache = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_BYTES)
+
+def apply_edits(document, ops):
+    """Применяет правки [{"op": "insert"|"delete"|"replace", "offset", "length", "text"}]"""
+    if not isinstance(ops, list):
+        raise ValueError("Expected {\"type\": \"doc_edit\", \"ops\": [...]}")
+    for op in ops:
+        if not isinstance(op, dict):
+            raise ValueError("правка должна быть объектом")
+        kind = op.get("op")
+        offset = op.get("offset")
+        if not isinstance(offset, int):
+            raise ValueError("offset должен быть целым")
+        if kind == "insert":
+            delete, insert = 0, op.get("text", "")
+        elif kind == "delete":
+            delete, insert = op.get("length", 0), ""
+        elif kind == "replace":
+            delete, insert = op.get("length", 0), op.get("text", "")
+        else:
+            raise ValueError(f"неизвестная правка: {kind}")
+        if not isinstance(delete, int):
+            raise ValueError("length должен быть целым")
+        if len(document.text) - delete + len(insert) > DOC_MAX_CHARS:
+            raise ValueError("документ слишком большой")
+        document.edit(offset, delete, insert)
+
+def document_state(document):
+    return {
+        "type": "doc_state",
+        "version": document.version,
+        "word_count": document.word_count,
+        "length_hist": document.length_hist,
+    }
+
+def load_state():
+    return snapshot_cache.get()
+
+def encode(message, binary):
+    if binary:
+        return binproto.encode_response(message)
+    return json.dumps(message, ensure_ascii=False)
+
+def encode_bytes(message, binary):
+    """Как encode, но JSON сразу в UTF-8 — для ответов, которые кэшируются"""
+    if binary:
+        return binproto.encode_response(message)
+    return json.dumps(message, ensure_ascii=False).encode("utf-8")
+
+async def send(websocket, message, binary, label, rid=None):
+    with metrics.Timer("send_seconds", label):
+        await websocket.send(encode(with_id(message, rid), binary))
+
+async def send_error(websocket, code, message, binary, label, rid=None):
+    await send(websocket, {"type": "error", "code": code, "message": message}, binary, label, rid)
+
+async def send_encoded(websocket, data, binary, label, rid=None):
+    with metrics.Timer("send_seconds", label):
+        await websocket.send(with_id_encoded(data, rid), text=not binary)
+
+EMPTY_RESTORE = {
+    "type": "restore",
+    "original": "",
+    "word_count": 0,
+    "length_hist": {},
+    "updated_at": None,
+}
+EMPTY_RESTORE_ENCODED = {binary: encode_bytes(EMPTY_RESTORE, binary) for binary in (False, True)}
 
 async def handler(websocket):
-    snapshot = load_state()
-    if snapshot:
+    if not admission.connect():
+        await websocket.close(1013, "Too many connections, retry later")
+        return
+    try:
+        await serve_client(websocket)
+    finally:
+        admission.disconnect()
+
+async def serve_client(websocket):
+    # бинарный подпротокол клиент выбирает при подключении, иначе — JSON
+    binary = websocket.subprotocol == binproto.SUBPROTOCOL
+    if load_state():
         try:
-            await websocket.send(json.dumps(snapshot, ensure_ascii=False))
+            await send_encoded(websocket, snapshot_cache.payload(binary), binary, "restore")
         except ConnectionClosedError:
             return
+    bucket = admission.bucket()
+    pipeline = Pipeline()
+    stream = None  # незавершённый text_begin ... text_end
+    document = None  # документ живого ввода: doc_open ... doc_close
+
+    async def process(data, rid, cost):
+        nonlocal stream, document
+        try:
+            if data.get("type") == "restore":
+                metrics.inc("messages_total", "restore")
+                with metrics.Timer("compute_seconds", "restore"):
+                    if load_state():
+                        data = snapshot_cache.payload(binary)
+                    else:
+                        data = EMPTY_RESTORE_ENCODED[binary]
+                await send_encoded(websocket, data, binary, "restore", rid)
+                return
+            kind = data.get("type")
+            if kind == "stats":
+                metrics.inc("messages_total", kind)
+                try:
+                    k = max(1, min(int(data.get("k", 10)), 100))
+                except (TypeError, ValueError):
+                    await send_error(websocket, binproto.ERR_BAD_REQUEST, "Expected {\"type\": \"stats\", \"k\": 10}", binary, "invalid", rid)
+                    return
+                with metrics.Timer("compute_seconds", kind):
+                    await fold_stats()
+                    reply = corpus.snapshot(k)
+                await send(websocket, reply, binary, kind, rid)
+                return
+            if kind == "history":
+                metrics.inc("messages_total", kind)
+                try:
+                    with metrics.Timer("compute_seconds", kind):
+                        items, next_id = await history.query(
+                            before_id=data.get("before_id"),
+                            since=data.get("since"),
+                            until=data.get("until"),
+                            limit=data.get("limit", 20),
+                            with_text=data.get("with_text", False),
+                        )
+                except (TypeError, ValueError):
+                    await send_error(
+                        websocket, binproto.ERR_BAD_REQUEST,
+                        "Expected {\"type\": \"history\", \"before_id\", \"since\", \"until\", \"limit\"}",
+                        binary, "invalid", rid,
+                    )
+                    return
+                await send(websocket, {"type": "history", "items": items, "next_before_id": next_id}, binary, kind, rid)
+                return
+            if kind in ("doc_open", "doc_edit", "doc_close"):
+                metrics.inc("messages_total", kind)
+                if kind != "doc_open" and document is None:
+                    await send_error(websocket, binproto.ERR_BAD_REQUEST, f"{kind} without doc_open", binary, "invalid", rid)
+                    return
+                try:
+                    with metrics.Timer("compute_seconds", kind):
+                        if kind == "doc_open":
+                            text = data.get("text", "")
+                            if not isinstance(text, str) or len(text) > DOC_MAX_CHARS:
+                                raise ValueError("Expected {\"type\": \"doc_open\", \"text\": \"...\"}")
+                            if len(text) > OFFLOAD_SIZE:
+                                # большой документ считаем в пуле, как и большой text
+                                try:
+                                    counts = await pool.run(textstats.analyze, text, cancel_on=websocket.wait_closed)
+                                except PoolBusy:
+                                    metrics.inc("offload_rejected_total")
+                                    await send_error(websocket, binproto.ERR_OVERLOADED, "Server is busy, retry later", binary, kind, rid)
+                                    return
+                                if counts is None:
+                                    metrics.inc("offload_cancelled_total")
+                                    return
+                                document = textstats.Document(text, counts)
+                            else:
+                                document = textstats.Document(text)
+                        elif kind == "doc_edit":
+                            apply_edits(document, data.get("ops"))
+                except (TypeError, ValueError) as e:
+                    reply = {"type": "error", "code": binproto.ERR_BAD_REQUEST, "message": str(e)}
+                    if document is not None:
+                        # часть правок могла примениться — клиент сверяется по версии
+                        reply["version"] = document.version
+                    await send(websocket, reply, binary, "invalid", rid)
+                    return
+                if kind != "doc_close":
+                    await send(websocket, document_state(document), binary, kind, rid)
+                    return
+                # закрытие документа — как обычный запрос с этим текстом
+                text = document.text
+                if len(text) > OFFLOAD_SIZE:
+                    try:
+                        with metrics.Timer("compute_seconds", "text_offload"):
+                            done = await analyze_offloaded(websocket, text)
+                    except PoolBusy:
+                        # документ остаётся открытым — doc_close можно повторить
+                        metrics.inc("offload_rejected_total")
+                        await send_error(websocket, binproto.ERR_OVERLOADED, "Server is busy, retry later", binary, kind, rid)
+                        return
+                    if done is None:
+                        return
+                    result = done[0]
+                else:
+                    with metrics.Timer("compute_seconds", "text"):
+                        result = analyze_text(text)
+                        log_request(websocket.remote_address, text, result)
+                        count_words(result["tokens"], result["length_hist"])
+                    with metrics.Timer("persist_seconds", "state"):
+                        save_state(result)
+                document = None
+                await send(websocket, client_result(result), binary, kind, rid)
+                return
+            if kind in ("text_begin", "text_chunk", "text_end"):
+                metrics.inc("messages_total", kind)
+                if kind == "text_begin":
+                    stream = TextStream()
+                    return
+                if stream is None:
+                    await send_error(websocket, binproto.ERR_BAD_REQUEST, f"{kind} without text_begin", binary, "invalid", rid)
+                    return
+                try:
+                    with metrics.Timer("compute_seconds", kind):
+                        if kind == "text_chunk":
+                            reply = stream.partial() if stream.feed(data.get("text", "")) else None
+                        else:
+                            reply = stream.finish()
+                            stream = None
+                except (UnicodeDecodeError, TypeError):
+                    stream = None
+                    await send_error(websocket, binproto.ERR_BAD_REQUEST, "Invalid text chunk", binary, "invalid", rid)
+                    return
+                if reply is None:
+                    return
+                if reply["type"] == "result":
+                    # слова потока не хранятся — в stats идут только длины
+                    corpus.add_lengths(reply["length_hist"])
+                    with metrics.Timer("persist_seconds", "state"):
+                        save_state(reply)
+                await send(websocket, reply, binary, kind, rid)
+                return
+            if kind == "analyze_batch":
+                metrics.inc("messages_total", kind)
+                texts = data.get("texts")
+                if not isinstance(texts, list) or not all(isinstance(t, str) for t in texts):
+                    await send_error(websocket, binproto.ERR_BAD_REQUEST, "Expected {\"texts\": [\"...\"]}", binary, "invalid", rid)
+                    return
+                if sum(map(len, texts)) > OFFLOAD_SIZE:
+                    try:
+                        with metrics.Timer("compute_seconds", "analyze_batch_offload"):
+                            results = await pool.run(textstats.analyze_batch, texts, cancel_on=websocket.wait_closed)
+                    except PoolBusy:
+                        metrics.inc("offload_rejected_total")
+                        await send_error(websocket, binproto.ERR_OVERLOADED, "Server is busy, retry later", binary, kind, rid)
+                        return
+                    if results is None:
+                        metrics.inc("offload_cancelled_total")
+                        return
+                else:
+                    with metrics.Timer("compute_seconds", kind):
+                        results = textstats.analyze_batch(texts)
+                for doc in results:
+                    corpus.add_lengths(doc["length_hist"])
+                reply = {
+                    "type": "batch_result",
+                    "results": results,
+                    "updated_at": datetime.now().isoformat(timespec="seconds"),
+                }
+                await send(websocket, reply, binary, kind, rid)
+                return
+            metrics.inc("messages_total", "text")
+            text = data.get("text", "")
+            if not isinstance(text, str):
+                await send_error(websocket, binproto.ERR_BAD_REQUEST, "Expected JSON with {\"text\": \"...\"}", binary, "invalid", rid)
+                return
+            key = result_cache.key(text)
+            cached = result_cache.get(key)
+            if cached is not None:
+                updated_at = datetime.now().isoformat(timespec="seconds")
+                with metrics.Timer("compute_seconds", "text_cached"):
+                    log_request(
+                        websocket.remote_address,
+                        text,
+                        {"word_count": cached.word_count, "length_hist": cached.length_hist},
+                    )
+                count_words(cached.words, cached.length_hist)
+                with metrics.Timer("persist_seconds", "state"):
+                    cached.store(text, updated_at)
+                await send_encoded(websocket, cached.payload(binary, updated_at), binary, "text", rid)
+                return
+            if len(text) > OFFLOAD_SIZE:
+                try:
+                    with metrics.Timer("compute_seconds", "text_offload"):
+                        done = await analyze_offloaded(websocket, text)
+                except PoolBusy:
+                    metrics.inc("offload_rejected_total")
+                    await send_error(websocket, binproto.ERR_OVERLOADED, "Server is busy, retry later", binary, "text", rid)
+                    return
+                if done is None:
+                    return
+                result, state_data, words = done
+            else:
+                with metrics.Timer("compute_seconds", "text"):
+                    result = analyze_text(text)
+                    log_request(websocket.remote_address, text, result)
+                    count_words(result["tokens"], result["length_hist"])
+                with metrics.Timer("persist_seconds", "state"):
+                    state_data = save_state(result)
+                words = None
+            if not result_cache.max_entries:
+                await send(websocket, client_result(result), binary, "text", rid)
+                return
+            if words is None:
+                words = Counter(result["tokens"]).most_common(STATS_DOC_TOP)
+            cached = CachedResult(result, state_data, words)
+            result_cache.put(key, cached)
+            await send_encoded(websocket, cached.payload(binary, result["updated_at"]), binary, "text", rid)
+        finally:
+            admission.release(cost)
+
     try:
         async for message in websocket:
+            cost = max(1, len(message))
+            rejected = admission.admit(bucket, cost)
+            if rejected is not None:
+                # отказ — до разбора: перегруженный воркер не тратит время на сообщение;
+                # ответ без id всё равно идёт в свою очередь
+                metrics.inc("messages_total", "rejected")
+                rid = None if binary else request_id(message)
+                await pipeline.submit([ORDERED] if rid is None else [], send, websocket, rejected, binary, "rejected", rid)
+                continue
             try:
-                data = json.loads(message)
-            except json.JSONDecodeError:
-                await websocket.send(
-                    json.dumps(
-                        {
-                            "type": "error",
-                            "message": "Expected JSON with {\"text\": \"...\"}",
-                        },
-                        ensure_ascii=False,
-                    )
+                with metrics.Timer("parse_seconds"):
+                    if isinstance(message, bytes):
+                        data = binproto.decode_request(message)
+                    else:
+                        data = json.loads(message)
+                if not isinstance(data, dict):
+                    raise ValueError("not an object")
+            except (ValueError, struct.error):
+                admission.release(cost)
+                metrics.inc("messages_total", "invalid")
+                await pipeline.submit(
+                    [ORDERED], send_error, websocket, binproto.ERR_BAD_REQUEST,
+                    "Expected JSON with {\"text\": \"...\"}", binary, "invalid",
                 )
                 continue
-            if data.get("type") == "restore":
-                snap = load_state()
-                if snap:
-                    await websocket.send(json.dumps(snap, ensure_ascii=False))
-                else:
-                    await websocket.send(
-                        json.dumps(
-                            {
-                                "type": "restore",
-                                "original": "",
-                                "word_count": 0,
-                                "length_hist": {},
-                                "updated_at": None,
-                            },
-                            ensure_ascii=False,
-                        )
-                    )
-                continue
-            text = data.get("text", "")
-            result = analyze_text(text)
-            log_request(websocket.remote_address, text, result)
-            save_state(result)
-            result_to_client = {
-                "type": "result",
-                "original": result["original"],
-                "word_count": result["word_count"],
-                "length_hist": result["length_hist"],
-                "updated_at": result["updated_at"],
-            }
-            await websocket.send(json.dumps(result_to_client, ensure_ascii=False))
+            kind = data.get("type")
+            # в бинарных ответах id не передать — там всё по очереди
+            rid = None if binary else data.get("id")
+            # без id — строго по очереди; поток текста и документ — всегда по очереди
+            lanes = [ORDERED] if rid is None else []
+            if kind in ("text_begin", "text_chunk", "text_end"):
+                lanes.append("stream")
+            elif kind in ("doc_open", "doc_edit", "doc_close"):
+                lanes.append("document")
+            try:
+                await pipeline.submit(lanes, process, data, rid, cost)
+            except BaseException:
+                # задача не создана — process не освободит cost сам
+                admission.release(cost)
+                raise
     except ConnectionClosedError:
         pass
+    finally:
+        await pipeline.close()
+
+metrics.gauge("connections", lambda: admission.connections)
+metrics.gauge("inflight", lambda: admission.inflight)
+metrics.gauge("log_dropped", wslog.dropped)
+metrics.gauge("offload_pending", lambda: pool.pending)
+metrics.gauge("result_cache_entries", lambda: len(result_cache.entries))
+metrics.gauge("result_cache_bytes", lambda: result_cache.size)
 
 async def main():
-    print(f"Starting WebSocket server on ws://{HOST}:{PORT}")
-    async with websockets.serve(
-        handler, HOST, PORT, ping_interval=20, ping_timeout=20
-    ):
-        await asyncio.Future()
+    wslog.setup()
+    await metrics.start(reuse_port=prefork.enabled())
+    await load_history()
+    stats_task = asyncio.create_task(stats_loop())
+    loop = asyncio.get_running_loop()
+    stop = loop.create_future()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, lambda: stop.done() or stop.set_result(None))
+        except NotImplementedError:  # Windows
+            pass
+    log.info("Starting WebSocket server on ws://%s:%s", HOST, PORT)
+    try:
+        async with websockets.serve(
+            handler, HOST, PORT, ping_interval=20, ping_timeout=20, reuse_port=prefork.enabled(),
+            max_size=MAX_MESSAGE_SIZE, select_subprotocol=binproto.select_subprotocol,
+            process_request=admission.process_request,
+        ):
+            await stop
+    finally:
+        stats_task.cancel()
+        pool.close()
+        # сохраняем то, что ещё не успело уйти в историю
+        await history.close()
+        wslog.shutdown()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if prefork.enabled():
+        shared_snapshot = prefork.SharedSnapshot(SNAPSHOT_CAPACITY)
+    prefork.run(main)
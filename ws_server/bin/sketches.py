@@ -0,0 +1,166 @@
+"""Статистика по всем текстам server2.py в фиксированной памяти.
+
+    SpaceSaving   top-K частых слов: следит не больше чем за capacity словами,
+                  у каждого — счётчик и верхняя граница ошибки
+    HyperLogLog   оценка числа разных слов по 2**precision регистрам
+    CorpusStats   всё вместе + распределение длин слов (длины от max_length
+                  и выше копятся в одной корзине); память не зависит от
+                  числа запросов
+
+Хэш для HyperLogLog — blake2b, а не hash(): он одинаков во всех
+процессах, и регистры из пула процессов можно сливать с основными.
+"""
+import hashlib
+import heapq
+import math
+import os
+from collections import Counter
+
+STATS_TOPK_CAPACITY = int(os.environ.get("STATS_TOPK_CAPACITY", "1000"))
+STATS_HLL_PRECISION = int(os.environ.get("STATS_HLL_PRECISION", "14"))
+STATS_MAX_LENGTH = int(os.environ.get("STATS_MAX_LENGTH", "64"))
+# Сколько разных слов копить до свёртки в скетчи
+STATS_PENDING_MAX = int(os.environ.get("STATS_PENDING_MAX", "20000"))
+
+
+class SpaceSaving:
+    def __init__(self, capacity=STATS_TOPK_CAPACITY):
+        self.capacity = capacity
+        self.counts = {}  # слово -> (счёт, ошибка)
+        # min-куча (счёт, слово) с ленивым удалением устаревших записей
+        self.heap = []
+
+    def update(self, item, count=1):
+        entry = self.counts.get(item)
+        if entry is not None:
+            total = entry[0] + count
+            self.counts[item] = (total, entry[1])
+        elif len(self.counts) < self.capacity:
+            total = count
+            self.counts[item] = (total, 0)
+        else:
+            # вытесняем слово с наименьшим счётом, новое наследует его счёт как ошибку
+            while True:
+                floor, victim = heapq.heappop(self.heap)
+                if self.counts.get(victim, (None,))[0] == floor:
+                    break
+            del self.counts[victim]
+            total = floor + count
+            self.counts[item] = (total, floor)
+        heapq.heappush(self.heap, (total, item))
+        if len(self.heap) > 4 * self.capacity:
+            self.heap = [(c, w) for w, (c, _) in self.counts.items()]
+            heapq.heapify(self.heap)
+
+    def top(self, k):
+        """[(слово, счёт, ошибка)] по убыванию счёта"""
+        best = heapq.nlargest(k, self.counts.items(), key=lambda kv: kv[1][0])
+        return [(word, count, error) for word, (count, error) in best]
+
+
+class HyperLogLog:
+    def __init__(self, precision=STATS_HLL_PRECISION):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, items):
+        """Добавляет слова (итерируемое)"""
+        registers = self.registers
+        shift = 64 - self.precision
+        mask = (1 << shift) - 1
+        blake2b = hashlib.blake2b
+        for item in items:
+            h = int.from_bytes(blake2b(item.encode("utf-8"), digest_size=8).digest(), "little")
+            rank = shift - (h & mask).bit_length() + 1
+            index = h >> shift
+            if rank > registers[index]:
+                registers[index] = rank
+
+    def merge(self, registers):
+        """Сливает регистры другого HyperLogLog той же точности"""
+        self.registers = bytearray(map(max, self.registers, registers))
+
+    def estimate(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if raw <= 2.5 * m and zeros:
+            # малые мощности — линейный счёт точнее
+            return round(m * math.log(m / zeros))
+        return round(raw)
+
+
+def summarize(words, capacity=STATS_TOPK_CAPACITY, precision=STATS_HLL_PRECISION):
+    """Свёртка слов (список или {слово: счёт}) для CorpusStats.merge: (top, регистры HLL).
+
+    Самая дорогая часть — хэширование каждого разного слова, поэтому
+    сервер вызывает её в пуле процессов.
+    """
+    counts = Counter(words)
+    hll = HyperLogLog(precision)
+    hll.add(counts)
+    return counts.most_common(capacity), bytes(hll.registers)
+
+
+class CorpusStats:
+    """Сводная статистика; слова копятся в pending и сворачиваются в скетчи пачками.
+
+    add_words стоит одного Counter.update (в C), а дорогое обновление
+    скетчей делается summarize() раз в интервал для всех накопленных
+    слов сразу — повторы между запросами к тому моменту уже схлопнуты.
+    pending ограничен pending_max разными словами.
+    """
+
+    def __init__(
+        self,
+        capacity=STATS_TOPK_CAPACITY,
+        precision=STATS_HLL_PRECISION,
+        max_length=STATS_MAX_LENGTH,
+        pending_max=STATS_PENDING_MAX,
+    ):
+        self.top = SpaceSaving(capacity)
+        self.distinct = HyperLogLog(precision)
+        self.max_length = max_length
+        self.pending_max = pending_max
+        self.pending = Counter()
+        self.length_hist = {}
+        self.documents = 0
+        self.words = 0
+
+    def add_lengths(self, length_hist):
+        """Учитывает текст в числе документов, слов и распределении длин"""
+        self.documents += 1
+        for length, count in length_hist.items():
+            length = min(int(length), self.max_length)
+            self.length_hist[length] = self.length_hist.get(length, 0) + count
+            self.words += count
+
+    def add_words(self, words):
+        """Слова текста (список или {слово: счёт}); True — pending пора сворачивать"""
+        self.pending.update(words)
+        return len(self.pending) >= self.pending_max
+
+    def take_pending(self):
+        pending, self.pending = self.pending, Counter()
+        return pending
+
+    def merge(self, summary):
+        """Вливает свёртку summarize()"""
+        common, registers = summary
+        for word, count in common:
+            self.top.update(word, count)
+        self.distinct.merge(registers)
+
+    def snapshot(self, k=10):
+        return {
+            "type": "stats",
+            "documents": self.documents,
+            "words_total": self.words,
+            "distinct_words": self.distinct.estimate(),
+            "top_words": [
+                {"word": word, "count": count, "error": error} for word, count, error in self.top.top(k)
+            ],
+            "length_hist": dict(sorted(self.length_hist.items())),
+            "length_overflow_from": self.max_length,
+        }
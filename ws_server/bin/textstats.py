@@ -0,0 +1,89 @@
+"""Подсчёт слов и гистограммы длин для server2.py.
+
+Слова выделяются одним проходом str.split() (в C, те же пробельные
+символы, что и у re.split(r"\\s+")), гистограмма строится сразу по
+массиву длин: np.bincount, если есть numpy, иначе Counter — тоже в C.
+Список слов возвращается только по запросу (keep_tokens), чтобы не
+держать и не сериализовать его, когда клиенту нужны лишь счётчики.
+"""
+from collections import Counter
+
+try:
+    import numpy as np
+except ImportError:  # numpy не обязателен
+    np = None
+
+
+def length_histogram(tokens):
+    """{длина: количество} для списка слов"""
+    if np is not None and tokens:
+        lengths = np.fromiter(map(len, tokens), dtype=np.int64, count=len(tokens))
+        counts = np.bincount(lengths)
+        nonzero = np.flatnonzero(counts)
+        return dict(zip(nonzero.tolist(), counts[nonzero].tolist()))
+    return dict(Counter(map(len, tokens)))
+
+
+def analyze(text, keep_tokens=False):
+    """(число слов, гистограмма длин, список слов или None)"""
+    tokens = text.split()
+    return len(tokens), length_histogram(tokens), tokens if keep_tokens else None
+
+
+def analyze_batch(texts):
+    """Счётчики для нескольких документов за один вызов"""
+    results = []
+    for text in texts:
+        word_count, length_hist, _ = analyze(text)
+        results.append({"word_count": word_count, "length_hist": length_hist})
+    return results
+
+
+class Document:
+    """Документ, который правят по месту (живой ввод), со счётчиками слов.
+
+    Правка пересчитывает только затронутый участок: от начала слова,
+    в которое попадает правка, до конца слова, где она заканчивается.
+    Слова за его пределами не меняются — их границы остаются
+    пробельными символами. Смещения — в символах Unicode (кодовых
+    точках), как у str в Python.
+    """
+
+    def __init__(self, text="", counts=None):
+        """counts — готовый результат analyze(text) (например, из пула процессов)"""
+        self.text = text
+        self.word_count, self.length_hist, _ = analyze(text) if counts is None else counts
+        self.version = 0
+
+    def _span(self, start, end):
+        text = self.text
+        while start > 0 and not text[start - 1].isspace():
+            start -= 1
+        size = len(text)
+        while end < size and not text[end].isspace():
+            end += 1
+        return start, end
+
+    def _count(self, fragment, sign):
+        hist = self.length_hist
+        for token in fragment.split():
+            length = len(token)
+            count = hist.get(length, 0) + sign
+            if count:
+                hist[length] = count
+            else:
+                del hist[length]
+            self.word_count += sign
+
+    def edit(self, offset, delete=0, insert=""):
+        """Удаляет delete символов с offset и вставляет туда insert"""
+        if not isinstance(insert, str):
+            raise TypeError("insert должен быть строкой")
+        size = len(self.text)
+        if not 0 <= offset <= size or delete < 0 or offset + delete > size:
+            raise ValueError(f"правка {offset}+{delete} за пределами документа длины {size}")
+        start, end = self._span(offset, offset + delete)
+        self._count(self.text[start:end], -1)
+        self.text = self.text[:offset] + insert + self.text[offset + delete:]
+        self._count(self.text[start:end - delete + len(insert)], 1)
+        self.version += 1
@@ -0,0 +1,95 @@
+"""Потоковый анализ текста для server2.py: text_begin / text_chunk / text_end.
+
+Текст приходит кусками и нигде не хранится целиком: считаются только
+число слов и гистограмма длин. Слово, разрезанное границей куска,
+склеивается по длине — от незаконченного слова помнится только его
+длина, так что память не зависит от размера документа. Слова делятся
+так же, как в analyze_text (по пробельным символам).
+
+Бинарные куски могут резать многобайтовый символ UTF-8 — их
+раскодирует инкрементальный декодер.
+"""
+import codecs
+import os
+import re
+from datetime import datetime
+
+# Как часто отправлять промежуточный результат, символов
+PARTIAL_INTERVAL = int(os.environ.get("TEXT_PARTIAL_INTERVAL", str(1 << 20)))
+
+_WORD = re.compile(r"\S+")
+
+
+class TextStream:
+    def __init__(self, partial_interval=PARTIAL_INTERVAL):
+        self.partial_interval = partial_interval
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.word_count = 0
+        self.length_hist = {}
+        self.chars = 0
+        self.pending = 0  # длина слова, которое может продолжиться в следующем куске
+        self.next_partial = partial_interval
+
+    def _count(self, length):
+        self.word_count += 1
+        self.length_hist[length] = self.length_hist.get(length, 0) + 1
+
+    def feed(self, chunk):
+        """Добавляет кусок (str или UTF-8 bytes); True — пора отправить partial()"""
+        if isinstance(chunk, (bytes, bytearray, memoryview)):
+            chunk = self.decoder.decode(chunk)
+        if not chunk:
+            return False
+        self.chars += len(chunk)
+        end = len(chunk)
+        pending = self.pending
+        last = None
+        for m in _WORD.finditer(chunk):
+            if last is not None:
+                self._count(last)
+            start, stop = m.span()
+            length = stop - start
+            if pending:
+                if start == 0:
+                    length += pending
+                else:
+                    self._count(pending)
+                pending = 0
+            last = length
+        if last is None:
+            # в куске одни пробелы — незаконченное слово закончилось
+            if pending:
+                self._count(pending)
+            self.pending = 0
+        elif stop == end:
+            self.pending = last
+        else:
+            self._count(last)
+            self.pending = 0
+        if self.chars >= self.next_partial:
+            self.next_partial = self.chars + self.partial_interval
+            return True
+        return False
+
+    def partial(self):
+        """Промежуточный результат (без незаконченного слова)"""
+        return {
+            "type": "partial",
+            "word_count": self.word_count,
+            "length_hist": dict(self.length_hist),
+            "chars": self.chars,
+        }
+
+    def finish(self):
+        """Итог в формате ответа на {"text": ...}, но без original"""
+        self.feed(self.decoder.decode(b"", final=True))
+        if self.pending:
+            self._count(self.pending)
+            self.pending = 0
+        return {
+            "type": "result",
+            "word_count": self.word_count,
+            "length_hist": self.length_hist,
+            "chars": self.chars,
+            "updated_at": datetime.now().isoformat(timespec="seconds"),
+        }
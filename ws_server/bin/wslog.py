@@ -0,0 +1,153 @@
+"""Неблокирующее логирование для WebSocket-серверов.
+
+Обработчики только кладут запись в ограниченную очередь, а форматирование
+и вывод делает фоновый поток (logging.handlers.QueueListener). Если
+очередь переполнена, запись выбрасывается и учитывается в dropped —
+консоль никогда не тормозит event loop.
+
+Настройка через переменные окружения:
+    LOG_LEVEL=INFO                  уровень логирования
+    LOG_FORMAT=text|json            обычный текст или JSON-строки
+    LOG_SAMPLE=recv=0.01,text=0.1   доля записей по типу сообщения
+    LOG_RATE=recv=20                не больше N записей в секунду по типу
+    LOG_QUEUE_SIZE=10000            размер очереди
+    WS_LOG_LEVEL=WARNING            уровень для логов библиотеки websockets
+
+Тип сообщения передаётся через extra={"msg_type": ...}; структурированные
+поля для JSON-вывода — через extra={"fields": {...}}.
+"""
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+# websockets пишет INFO на каждое соединение — при шторме переподключений это лишнее
+WS_LOG_LEVEL = os.environ.get("WS_LOG_LEVEL", "WARNING").upper()
+
+
+def _parse_map(value):
+    """"recv=0.01,text=0.1" -> {"recv": 0.01, "text": 0.1}"""
+    result = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        key, _, val = item.partition("=")
+        result[key.strip()] = float(val)
+    return result
+
+
+LOG_SAMPLE = _parse_map(os.environ.get("LOG_SAMPLE", ""))
+LOG_RATE = _parse_map(os.environ.get("LOG_RATE", ""))
+
+
+class SamplingFilter(logging.Filter):
+    """Сэмплирование и token bucket по типу сообщения (работает в потоке вызова)"""
+
+    def __init__(self, sample, rate):
+        super().__init__()
+        self.sample = sample
+        self.rate = rate
+        self.buckets = {}
+
+    def filter(self, record):
+        msg_type = getattr(record, "msg_type", None)
+        if msg_type is None:
+            return True
+        p = self.sample.get(msg_type)
+        if p is not None and random.random() >= p:
+            return False
+        rate = self.rate.get(msg_type)
+        if rate is None:
+            return True
+        now = time.monotonic()
+        tokens, last = self.buckets.get(msg_type, (rate, now))
+        tokens = min(rate, tokens + (now - last) * rate)
+        if tokens < 1:
+            self.buckets[msg_type] = (tokens, now)
+            return False
+        self.buckets[msg_type] = (tokens - 1, now)
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который не форматирует в потоке вызова и не ждёт при переполнении"""
+
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # форматирование — в фоновом потоке
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+        }
+        msg_type = getattr(record, "msg_type", None)
+        if msg_type is not None:
+            entry["msg_type"] = msg_type
+        fields = getattr(record, "fields", None)
+        if fields is not None:
+            entry.update(fields)
+        else:
+            entry["msg"] = record.getMessage()
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+_listener = None
+_handler = None
+
+
+def setup():
+    """Подключает очередь и фоновый поток к корневому логгеру.
+
+    Вызывается в каждом процессе-воркере (поток не переживает fork).
+    """
+    global _listener, _handler
+    if _listener is not None:
+        return
+    out = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == "json":
+        out.setFormatter(JsonFormatter())
+    else:
+        out.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    q = queue.Queue(LOG_QUEUE_SIZE)
+    _handler = DroppingQueueHandler(q)
+    _handler.addFilter(SamplingFilter(LOG_SAMPLE, LOG_RATE))
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    logging.getLogger("websockets").setLevel(WS_LOG_LEVEL)
+    root.addHandler(_handler)
+    _listener = logging.handlers.QueueListener(q, out)
+    _listener.start()
+
+
+def shutdown():
+    """Дописывает очередь и останавливает фоновый поток"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+        logging.getLogger().removeHandler(_handler)
+
+
+def dropped():
+    return _handler.dropped if _handler is not None else 0
@@ -0,0 +1,139 @@
+"""Тесты песочницы calc_expr: python -m pytest ws_server/test (или python -m unittest)"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bin"))
+
+from calc_expr import MAX_EXPR_LEN, ExpressionError, compile_expression  # noqa: E402
+
+
+def evaluate(text, **variables):
+    return compile_expression(text)(variables)
+
+
+class ArithmeticTest(unittest.TestCase):
+    def test_operators_and_precedence(self):
+        self.assertEqual(evaluate("a + b * 2", a=1.0, b=3.0), 7.0)
+        self.assertEqual(evaluate("(a + b) * 2", a=1.0, b=3.0), 8.0)
+        self.assertEqual(evaluate("-a % 3", a=4.0), 2.0)
+        self.assertEqual(evaluate("2 ** 10"), 1024.0)
+
+    def test_functions_and_constants(self):
+        self.assertAlmostEqual(evaluate("sqrt(x) + cos(pi)", x=16.0), 3.0)
+        self.assertEqual(evaluate("max(a, b, 0)", a=-1.0, b=-2.0), 0.0)
+
+    def test_result_is_float(self):
+        self.assertIsInstance(evaluate("1 + 2"), float)
+
+    def test_variables(self):
+        expr = compile_expression("a * x + b")
+        self.assertEqual(expr.variables, {"a", "b", "x"})
+        with self.assertRaisesRegex(ExpressionError, "x"):
+            expr({"a": 1.0, "b": 2.0})
+
+    def test_cache(self):
+        self.assertIs(compile_expression("a + 1"), compile_expression("a + 1"))
+
+    def test_division_by_zero(self):
+        with self.assertRaises(ZeroDivisionError):
+            evaluate("a / b", a=1.0, b=0.0)
+
+
+class SandboxTest(unittest.TestCase):
+    def assertRejected(self, text):
+        with self.assertRaises(ExpressionError):
+            compile_expression(text)
+
+    def test_no_builtins(self):
+        self.assertRejected("__import__('os')")
+        self.assertRejected("__import__('os').system('true')")
+        self.assertRejected("open('/etc/passwd')")
+        self.assertRejected("eval('1')")
+        self.assertRejected("exec('1')")
+        self.assertRejected("getattr(a, 'real')")
+
+    def test_no_attributes(self):
+        self.assertRejected("a.__class__")
+        self.assertRejected("(1).__class__.__bases__")
+        self.assertRejected("sqrt.__globals__")
+        self.assertRejected("().__class__.__base__.__subclasses__()")
+
+    def test_no_other_constructs(self):
+        for text in (
+            "lambda: 1",
+            "[1, 2]",
+            "(1, 2)",
+            "{1: 2}",
+            "a[0]",
+            "[x for x in b]",
+            "a if b else 1",
+            "a < b",
+            "a and b",
+            "a << 2",
+            "a // b",
+            "~a",
+            "not a",
+            "f'{a}'",
+            "(a := 1)",
+        ):
+            with self.subTest(text=text):
+                self.assertRejected(text)
+
+    def test_only_numeric_constants(self):
+        self.assertRejected("'abc'")
+        self.assertRejected("b'abc'")
+        self.assertRejected("True + 1")
+        self.assertRejected("None")
+        self.assertRejected("1j")
+
+    def test_functions_only_by_name(self):
+        self.assertRejected("sqrt")
+        self.assertRejected("sqrt(x=4)")
+        self.assertRejected("unknown(4)")
+
+    def test_builtins_unreachable_through_variables(self):
+        # имя __builtins__ — обычная переменная, а не словарь встроенных функций
+        self.assertEqual(evaluate("__builtins__ + 1", __builtins__=1.0), 2.0)
+
+    def test_syntax_error(self):
+        self.assertRejected("a +")
+        self.assertRejected("a; b")
+        self.assertRejected("import os")
+
+    def test_length_limit(self):
+        self.assertRejected("1+" * MAX_EXPR_LEN + "1")
+
+
+class OverflowTest(unittest.TestCase):
+    def test_huge_power_overflows_instead_of_hanging(self):
+        with self.assertRaises(OverflowError):
+            evaluate("10 ** 1000")
+        with self.assertRaises(OverflowError):
+            evaluate("9 ** 9 ** 9")
+        with self.assertRaises(OverflowError):
+            evaluate("pow(a, 400)", a=10.0)
+
+    def test_integer_literals_become_floats(self):
+        # длинная целая арифметика недоступна: литерал сразу float, а длиннее MAX_EXPR_LEN не бывает
+        self.assertEqual(evaluate("1" + "0" * 250), 1e250)
+
+    def test_float_overflow_is_an_error(self):
+        with self.assertRaises(OverflowError):
+            evaluate("a * a", a=1e300)
+        with self.assertRaises(OverflowError):
+            evaluate("a - a", a=float("inf"))
+
+    def test_math_overflow(self):
+        with self.assertRaises(OverflowError):
+            evaluate("exp(1000)")
+
+    def test_math_domain(self):
+        with self.assertRaises(ValueError):
+            evaluate("sqrt(-1)")
+        with self.assertRaises(ValueError):
+            evaluate("log(0)")
+
+
+if __name__ == "__main__":
+    unittest.main()
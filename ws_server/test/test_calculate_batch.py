@@ -0,0 +1,47 @@
+"""Тесты calculate_batch из server.py: с numpy и без него"""
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bin"))
+
+import binproto  # noqa: E402
+import server  # noqa: E402
+
+
+class CalculateBatchTest(unittest.TestCase):
+    def check(self):
+        results, errors = server.calculate_batch(
+            [1.0, 6.0, 1e308, 1.0, float("inf"), 2.0],
+            [2.0, 3.0, 1e308, 0.0, 1.0, 2.0],
+            ["+", "/", "*", "/", "-", "%"],
+        )
+        self.assertEqual(results, [3.0, 2.0, None, None, None, None])
+        self.assertEqual(
+            [(e["index"], e["code"]) for e in errors],
+            [
+                (2, binproto.ERR_OVERFLOW),
+                (3, binproto.ERR_DIV_ZERO),
+                (4, binproto.ERR_OVERFLOW),
+                (5, binproto.ERR_UNKNOWN_OP),
+            ],
+        )
+
+    @unittest.skipIf(server.np is None, "numpy не установлен")
+    def test_numpy(self):
+        self.check()
+
+    def test_pure_python(self):
+        with mock.patch.object(server, "np", None):
+            self.check()
+
+    def test_binary_reply_marks_overflow_as_error(self):
+        results, errors = server.calculate_batch([1e308], [1e308], ["*"])
+        message = {"type": "calculation_batch_result", "results": results, "errors": errors}
+        data = binproto.encode_response(message)
+        self.assertIn(binproto._BATCH_ERR.pack(0, binproto.ERR_OVERFLOW), data)
+
+
+if __name__ == "__main__":
+    unittest.main()